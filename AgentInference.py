@@ -0,0 +1,539 @@
+import os
+import threading
+from time import perf_counter as timer
+
+import numpy as np  # the NumPy runtime (class NumpyActor) runs without torch
+
+"""
+Policy inference for deployment. It only needs the forward pass of the actor.
+
+export_numpy_actor(): export a torch actor (ActorDPG, ActorDL, ActorSAC, ActorPPO, QNetwork) into a compact *.npz file
+NumpyActor: torch-free policy inference with the *.npz file, preallocated buffers and batched matmul
+quantize_actor_int8(): int8 dynamic quantization (per-channel weight of Linear) for CPU serving
+get_eva_reward_delta(): the reward of the float32 actor vs the int8 actor on the same evaluation episodes
+export_torch_script(): export a scripted, frozen, eval-mode actor (with the state normalization of PPO) into *.pt
+TorchScriptActor: load the *.pt file without AgentZoo and AgentNetwork, for fast cold start of inference process
+InferenceServer: load the actor once, coalesce the states of many clients (Unix socket) into batches (dynamic batching)
+InferenceClient: the drop-in for agent.select_actions() in the collection loops of env processes
+distill_actor(): train a compact ActorDPG (student) to match the actions of a trained actor (teacher), such as SNAC
+"""
+
+'''export (torch)'''
+
+
+def export_numpy_actor(act, npz_path, check_size=2 ** 8):
+    """
+    act: the actor of AgentZoo, nn.Module (ActorDPG, ActorDL, ActorSAC, ActorPPO (the mean path), QNetwork)
+    npz_path: such as '{}/actor.npz'.format(cwd)
+    It checks the NumPy runtime against the torch actor (float32 tolerance) after export.
+    """
+    import copy
+    import torch
+    act = copy.deepcopy(act).cpu().eval()  # keep the device and the train mode of the actor of caller
+
+    op_list = get_numpy_op_list(act)
+    state_dim = op_list[0][1].shape[0]
+    is_discrete = act.__class__.__name__ == 'QNetwork'  # select_actions() of AgentDQN use argmax
+
+    ary_dict = {'op_names': np.array([op[0] for op in op_list]),
+                'is_discrete': np.array(is_discrete), }
+    for i, op in enumerate(op_list):
+        for j, ary in enumerate(op[1:]):
+            ary_dict['{}_{}'.format(i, j)] = ary
+    np.savez(npz_path, **ary_dict)
+
+    '''check the NumPy runtime'''
+    states = np.random.randn(check_size, state_dim).astype(np.float32)
+    with torch.no_grad():
+        outputs = get_torch_output(act, torch.tensor(states)).numpy()
+    np_outputs = NumpyActor(npz_path, max_batch_size=check_size).forward(states)
+    np.testing.assert_allclose(np_outputs, outputs, rtol=1e-4, atol=1e-5)
+    return npz_path
+
+
+def export_numpy_actor_pth(cwd, act, npz_name='actor.npz'):  # load cwd/actor.pth (saved by Recorder), then export
+    import torch
+    act_dict = torch.load('{}/actor.pth'.format(cwd), map_location=lambda storage, loc: storage)
+    act.load_state_dict(act_dict)
+    return export_numpy_actor(act, '{}/{}'.format(cwd, npz_name))
+
+
+def get_torch_output(act, states):  # the network output without explore noise, that NumpyActor.forward() computes
+    return act(states)  # ActorSAC, ActorPPO: the mean path. QNetwork: Q values
+
+
+def get_numpy_op_list(act):  # op: (op_name, *arrays). The weight of Linear is transposed to (in_dim, out_dim)
+    name = act.__class__.__name__
+    if name == 'ActorSAC':
+        return get_sequential_op_list(act.net) + [get_linear_op(act.net__mean), ('tanh',)]
+    if name == 'ActorPPO':
+        return get_sequential_op_list(act.net_action)
+    if name == 'ActorCriticPPO':  # the trunk and the action head, without the value head
+        return get_sequential_op_list(act.net_trunk) + [get_linear_op(act.net_action)]
+    return get_sequential_op_list(act.net)
+
+
+def get_sequential_op_list(net):
+    op_list = list()
+    for module in net:
+        name = module.__class__.__name__
+        if name == 'Linear':
+            op_list.append(get_linear_op(module))
+        elif name == 'DenseNet':
+            w1, b1 = get_linear_op(module.dense1[0])[1:]
+            w2, b2 = get_linear_op(module.dense2[0])[1:]
+            op_list.append(('densenet', w1, b1, w2, b2))
+        elif name in {'ReLU', 'Tanh', 'HardSwish'}:
+            op_list.append((name.lower(),))
+        else:
+            raise NotImplementedError("| export_numpy_actor() doesn't support: {}".format(name))
+    return op_list
+
+
+def get_linear_op(linear):
+    state_dict = {k: v.detach().cpu().numpy().astype(np.float32) for k, v in linear.state_dict().items()}
+    if 'weight_orig' in state_dict:  # fold spectral norm (eval mode): weight = weight_orig / sigma
+        weight = state_dict['weight_orig']
+        sigma = np.dot(state_dict['weight_u'], np.dot(weight, state_dict['weight_v']))
+        weight = weight / sigma
+    else:
+        weight = state_dict['weight']
+    return 'linear', np.ascontiguousarray(weight.T), state_dict['bias']
+
+
+'''int8 dynamic quantization (torch)'''
+
+
+def quantize_actor_int8(act):  # return a quantized copy of actor on CPU, the input and output are still float32
+    import copy
+    import torch
+    act = copy.deepcopy(act).cpu().eval()
+    act.device = torch.device('cpu')
+
+    for module in act.modules():  # fold spectral norm (QNetwork) into weight before quantization
+        if hasattr(module, 'weight_orig'):
+            torch.nn.utils.remove_spectral_norm(module)
+
+    qconfig_spec = {torch.nn.Linear: torch.quantization.per_channel_dynamic_qconfig}
+    return torch.quantization.quantize_dynamic(act, qconfig_spec, dtype=torch.qint8)
+
+
+class ActorAgent:  # the select_actions() of agent for get_eva_reward(), without critic and optimizer
+    def __init__(self, act, is_discrete=False):
+        self.act = act
+        self.is_discrete = is_discrete
+
+    def select_actions(self, states, explore_noise=0.0):  # evaluate without explore noise
+        import torch
+        with torch.no_grad():
+            states = torch.as_tensor(np.array(states), dtype=torch.float32)
+            outputs = get_torch_output(self.act, states)
+        return outputs.argmax(dim=1).numpy() if self.is_discrete else outputs.numpy()
+
+
+def get_eva_reward_delta(act, q_act, env_list, max_step, max_action, random_seed=19430):
+    """
+    Replay the same evaluation episodes (env.seed) through get_eva_reward for the float32 and the int8 actor.
+    It also compares the teacher and the student actor of distill_actor().
+    max_action can be None for Discrete action space (QNetwork)
+    return: (rewards of float32 actor, rewards of int8 actor)
+    """
+    import copy
+    from AgentZoo import get_eva_reward
+    is_discrete = act.__class__.__name__ == 'QNetwork'
+
+    reward_lists = list()
+    for actor in (copy.deepcopy(act).cpu(), q_act):  # keep the device of the actor of caller
+        for i, env in enumerate(env_list):
+            env.seed(random_seed + i)
+        reward_lists.append(get_eva_reward(ActorAgent(actor, is_discrete), env_list, max_step, max_action))
+    return reward_lists
+
+
+'''TorchScript export (torch)'''
+
+
+def export_torch_script(act, pt_path, state_norm=None):
+    """
+    act: the actor of AgentZoo, nn.Module (ActorDPG, ActorDL, ActorSAC, ActorPPO (the mean path), QNetwork)
+    pt_path: such as '{}/actor_script.pt'.format(cwd)
+    state_norm: AutoNormalization of PPO, its mean and std are baked into the exported actor
+    """
+    import copy
+    import torch
+    from AgentNetwork import ActorScript
+    act = copy.deepcopy(act).cpu().eval()
+
+    for module in act.modules():  # the hook of spectral norm (QNetwork) can't be scripted
+        if hasattr(module, 'weight_orig'):
+            torch.nn.utils.remove_spectral_norm(module)
+
+    name = act.__class__.__name__
+    if name == 'ActorSAC':
+        net = torch.nn.Sequential(*act.net, act.net__mean, torch.nn.Tanh())
+    elif name == 'ActorPPO':
+        net = act.net_action
+    elif name == 'ActorCriticPPO':
+        net = torch.nn.Sequential(*act.net_trunk, act.net_action)
+    else:
+        net = act.net
+    state_dim = get_numpy_op_list(act)[0][1].shape[0]
+
+    state_mean = np.zeros(state_dim)
+    state_std = np.ones(state_dim)
+    clip = np.inf
+    if state_norm is not None:  # the same as AutoNormalization.__call__(x, update=False)
+        if state_norm.demean:
+            state_mean = state_norm.rs.mean
+        if state_norm.destd:
+            state_std = state_norm.rs.std + 1e-8
+        if state_norm.clip:
+            clip = state_norm.clip
+
+    act_script = ActorScript(net, state_mean, state_std, clip, is_discrete=(name == 'QNetwork')).eval()
+    act_script = torch.jit.freeze(torch.jit.script(act_script))
+    torch.jit.save(act_script, pt_path)
+    return pt_path
+
+
+class TorchScriptActor:  # select_actions() with the actor exported by export_torch_script()
+    def __init__(self, pt_path, num_threads=None):
+        import torch
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self.act = torch.jit.load(pt_path, map_location='cpu')
+
+    def select_actions(self, states):  # states: np.array, shape == (batch_size, state_dim)
+        import torch
+        with torch.no_grad():
+            states = torch.as_tensor(np.asarray(states, dtype=np.float32))
+            return self.act(states).numpy()
+
+    def select_action(self, state):  # one state, shape == (state_dim, )
+        return self.select_actions((state,))[0]
+
+
+'''runtime (NumPy)'''
+
+
+class NumpyActor:
+    def __init__(self, npz_path, max_batch_size=2 ** 6):
+        ary_dict = np.load(npz_path)
+        self.is_discrete = bool(ary_dict['is_discrete'])
+
+        self.op_list = list()
+        for i, op_name in enumerate(ary_dict['op_names']):
+            arrays = list()
+            j = 0
+            while '{}_{}'.format(i, j) in ary_dict.files:
+                arrays.append(ary_dict['{}_{}'.format(i, j)].astype(np.float32))
+                j += 1
+            self.op_list.append((str(op_name), arrays))
+        self.state_dim = self.op_list[0][1][0].shape[0]
+
+        self.max_batch_size = 0
+        self.buffers = list()
+        self.init_buffers(max_batch_size)
+
+    def init_buffers(self, max_batch_size):  # preallocate an output buffer for each Linear and DenseNet
+        self.max_batch_size = max_batch_size
+        self.buffers = list()
+        for op_name, arrays in self.op_list:
+            if op_name == 'linear':
+                self.buffers.append(np.empty((max_batch_size, arrays[0].shape[1]), dtype=np.float32))
+            elif op_name == 'densenet':
+                mid_dim = arrays[0].shape[0]  # output: cat((x1, x2, x3)), x1.shape[1] == mid_dim
+                self.buffers.append(np.empty((max_batch_size, mid_dim * 4), dtype=np.float32))
+            else:  # activation in place, hardswish needs a temporary buffer
+                self.buffers.append(None)
+        max_dim = max(buf.shape[1] for buf in self.buffers if buf is not None)
+        self.tmp_buffer = np.empty((max_batch_size, max_dim), dtype=np.float32)
+
+    def forward(self, states):  # NOTICE! the output array is reused in next call
+        x = np.asarray(states, dtype=np.float32)
+        batch_size = x.shape[0]
+        if batch_size > self.max_batch_size:
+            self.init_buffers(batch_size)
+
+        for (op_name, arrays), buffer in zip(self.op_list, self.buffers):
+            if op_name == 'linear':
+                x = self.linear(x, arrays[0], arrays[1], buffer[:batch_size])
+            elif op_name == 'relu':
+                np.maximum(x, 0.0, out=x)
+            elif op_name == 'tanh':
+                np.tanh(x, out=x)
+            elif op_name == 'hardswish':
+                self.hard_swish(x, self.tmp_buffer[:batch_size, :x.shape[1]])
+            elif op_name == 'densenet':
+                x = self.dense_net(x, arrays, buffer[:batch_size])
+        return x
+
+    def select_actions(self, states):  # the same as agent.select_actions() without explore noise
+        outputs = self.forward(states)
+        return outputs.argmax(axis=1) if self.is_discrete else outputs.copy()
+
+    @staticmethod
+    def linear(x, weight, bias, out):
+        np.matmul(x, weight, out=out)
+        out += bias
+        return out
+
+    @staticmethod
+    def hard_swish(x, tmp):  # HardSwish: relu6(x + 3) / 6 * x, in place
+        np.add(x, 3.0, out=tmp)
+        np.clip(tmp, 0.0, 6.0, out=tmp)
+        tmp /= 6.0
+        x *= tmp
+
+    def dense_net(self, x1, arrays, out):  # DenseNet: x2 = cat((x1, dense1(x1))), x3 = cat((x2, dense2(x2)))
+        w1, b1, w2, b2 = arrays
+        mid_dim = x1.shape[1]
+        out[:, :mid_dim] = x1
+
+        x = self.linear(x1, w1, b1, out[:, mid_dim:mid_dim * 2])
+        self.hard_swish(x, self.tmp_buffer[:x.shape[0], :mid_dim])
+
+        x = self.linear(out[:, :mid_dim * 2], w2, b2, out[:, mid_dim * 2:])
+        self.hard_swish(x, self.tmp_buffer[:x.shape[0], :mid_dim * 2])
+        return out
+
+
+'''policy distillation (torch)'''
+
+
+def distill_actor(teacher, env, max_action, student_dim=2 ** 6, buffer=None, round_num=2 ** 3, max_step=2 ** 10,
+                  rollout_step=2 ** 12, update_times=2 ** 9, batch_size=2 ** 8, explore_noise=0.1, learning_rate=1e-3):
+    """
+    teacher: the trained actor (continuous action space), such as ActorDL of AgentSNAC
+    buffer: BufferArray, replay the states of the replay buffer. The states of fresh rollouts are added in each round.
+    The first round rolls out the teacher, the next rounds roll out the student and label its states by teacher
+    (DAgger), so that the student learns the actions in the states that it visits.
+    return: the student, ActorDPG(state_dim, action_dim, student_dim) on CPU
+    """
+    import copy
+    import torch
+    from AgentNetwork import ActorDPG
+    teacher = copy.deepcopy(teacher).cpu().eval()  # keep the device and the train mode of the actor of caller
+    state_dim = env.observation_space.shape[0]
+
+    def get_teacher_actions(states):
+        with torch.no_grad():
+            return get_torch_output(teacher, states).clamp(-1.0, 1.0)  # the student output tanh()
+
+    action_dim = get_teacher_actions(torch.zeros((1, state_dim))).shape[1]
+    student = ActorDPG(state_dim, action_dim, student_dim)
+    student.device = torch.device('cpu')
+    optimizer = torch.optim.Adam(student.parameters(), lr=learning_rate)
+    criterion = torch.nn.MSELoss()
+
+    state_list = list()
+    if buffer is not None:
+        buffer.init_before_sample()
+        state_list.append(buffer.memories[:buffer.now_len, 2:buffer.state_idx])
+
+    for round_i in range(round_num):
+        '''roll out and collect the states'''
+        policy = teacher if round_i == 0 else student.eval()
+        states = np.empty((rollout_step, state_dim), dtype=np.float32)
+        state = env.reset()
+        episode_step = 0
+        for i in range(rollout_step):
+            states[i] = state
+            with torch.no_grad():
+                action = get_torch_output(policy, torch.as_tensor(states[i:i + 1]))[0].numpy()
+            action = (action + np.random.randn(action_dim) * explore_noise).clip(-1.0, 1.0)
+
+            state, reward, done, _ = env.step(action * max_action)
+            episode_step += 1
+            if done or episode_step >= max_step:
+                state = env.reset()
+                episode_step = 0
+        state_list.append(states)
+
+        '''fit the actions of teacher'''
+        student.train()
+        all_states = torch.as_tensor(np.concatenate(state_list))
+        all_actions = get_teacher_actions(all_states)
+        for _ in range(update_times):
+            indices = torch.randint(len(all_states), size=(batch_size,))
+            loss = criterion(student(all_states[indices]), all_actions[indices])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        print("| distill_actor round {:2}  states {:8}  loss {:.2e}".format(round_i, len(all_states), loss.item()))
+
+    return student.eval()
+
+
+'''dynamic batching inference server (Unix socket)'''
+
+
+class InferenceServer:
+    def __init__(self, address, select_actions, max_batch_size=2 ** 8, max_wait=1e-3):
+        """
+        address: the path of Unix socket, such as '{}/inference.sock'.format(cwd)
+        select_actions: states -> actions, such as TorchScriptActor(pt_path).select_actions
+        max_wait: the max waiting time (second) of the first request in a batch before forward
+        """
+        self.address = address
+        self.select_actions = select_actions
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.conns = list()
+        self.conns_lock = threading.Lock()
+        self.is_serving = True
+
+        '''counters'''
+        self.start_time = timer()
+        self.request_num = 0
+        self.state_num = 0
+        self.batch_num = 0
+        self.forward_time = 0.0
+        self.latencies = np.zeros(2 ** 12)  # ring buffer, from receiving a request to sending its actions
+
+    def accept_forever(self, listener):
+        while self.is_serving:
+            try:
+                conn = listener.accept()
+            except OSError:  # the listener is closed
+                break
+            with self.conns_lock:
+                self.conns.append(conn)
+
+    def serve_forever(self):
+        from multiprocessing.connection import Listener, wait
+        if os.path.exists(self.address):
+            os.remove(self.address)  # the socket file of last run
+        listener = Listener(self.address, family='AF_UNIX')
+        threading.Thread(target=self.accept_forever, args=(listener,), daemon=True).start()
+        print("| InferenceServer: {}".format(self.address))
+
+        while self.is_serving:
+            with self.conns_lock:
+                conns = self.conns.copy()
+            ready_conns = wait(conns, timeout=0.1)
+            if not ready_conns:
+                continue
+
+            '''coalesce the requests until the batch is full or the deadline of the first request'''
+            requests = list()  # [(conn, states, recv_time), ...]
+            batch_size = 0
+            deadline = timer() + self.max_wait
+            while True:
+                for conn in ready_conns:
+                    batch_size += self.recv_request(conn, requests)
+
+                wait_time = deadline - timer()
+                if batch_size >= self.max_batch_size or wait_time <= 0 or not self.is_serving:
+                    break
+                with self.conns_lock:
+                    conns = self.conns.copy()
+                ready_conns = wait(conns, timeout=wait_time)
+
+            if requests:
+                self.send_actions(requests)
+        listener.close()
+
+    def recv_request(self, conn, requests):  # return the number of states
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):  # the client exit
+            message = None
+
+        if message is None:
+            with self.conns_lock:
+                self.conns.remove(conn)
+            conn.close()
+        elif isinstance(message, str):
+            if message == 'stats':
+                conn.send(self.get_stats())
+            elif message == 'shutdown':
+                self.is_serving = False
+        else:
+            requests.append((conn, message, timer()))
+            return len(message)
+        return 0
+
+    def send_actions(self, requests):
+        states = np.concatenate([request[1] for request in requests])
+        start_time = timer()
+        actions = self.select_actions(states)
+        self.forward_time += timer() - start_time
+
+        i = 0
+        for conn, request_states, recv_time in requests:
+            j = i + len(request_states)
+            try:
+                conn.send(actions[i:j])
+            except OSError:  # the client exit, it will be removed in recv_request()
+                pass
+            i = j
+            self.latencies[self.request_num % len(self.latencies)] = timer() - recv_time
+            self.request_num += 1
+        self.state_num += len(states)
+        self.batch_num += 1
+
+    def get_stats(self):
+        latencies = self.latencies[:min(self.request_num, len(self.latencies))]
+        p50, p99 = np.percentile(latencies, (50, 99)) * 1e6 if len(latencies) else (0.0, 0.0)
+        return {'request_num': self.request_num,
+                'batch_num': self.batch_num,
+                'avg_batch_size': self.state_num / max(self.batch_num, 1),
+                'states_per_second': self.state_num / (timer() - self.start_time),
+                'forward_time': self.forward_time,
+                'latency_p50_us': p50,
+                'latency_p99_us': p99, }
+
+
+def process__inference_server(address, load_policy, max_batch_size=2 ** 8, max_wait=1e-3):
+    """
+    load_policy: load the actor in the server process, such as functools.partial(TorchScriptActor, pt_path)
+    """
+    policy = load_policy()
+    server = InferenceServer(address, policy.select_actions, max_batch_size, max_wait)
+    server.serve_forever()
+    print("| InferenceServer stats: {}".format(server.get_stats()))
+
+
+class InferenceClient:  # drop-in for agent.select_actions(states, explore_noise)
+    def __init__(self, address):
+        from multiprocessing.connection import Client
+        self.conn = Client(address, family='AF_UNIX')
+
+    def select_actions(self, states, explore_noise=0.0):
+        self.conn.send(np.asarray(states, dtype=np.float32))
+        actions = self.conn.recv()
+        if explore_noise != 0.0:  # the same as ActorDPG.add_noise(), for continuous action space
+            normal_noise = (np.random.randn(*actions.shape) * explore_noise).clip(-0.5, 0.5)
+            actions = (actions + normal_noise).clip(-1.0, 1.0)
+        return actions
+
+    def select_action(self, state, explore_noise=0.0):
+        return self.select_actions((state,), explore_noise)[0]
+
+    def get_stats(self):  # the counters of InferenceServer
+        self.conn.send('stats')
+        return self.conn.recv()
+
+    def shutdown_server(self):
+        self.conn.send('shutdown')
+
+    def close(self):
+        self.conn.send(None)
+        self.conn.close()
+
+
+def run__numpy_actor(cwd='AC_BasicAC/LL_0'):  # export the actor saved by Recorder, then check it
+    from AgentNetwork import ActorDL
+    state_dim, action_dim, net_dim = 8, 2, 2 ** 7  # LunarLanderContinuous-v2, AgentBasicAC
+
+    npz_path = export_numpy_actor_pth(cwd, ActorDL(state_dim, action_dim, net_dim, use_dense=False))
+    print("| Export: {} ({} bytes)".format(npz_path, os.path.getsize(npz_path)))
+
+    actor = NumpyActor(npz_path)
+    print("| NumpyActor actions:", actor.select_actions(np.zeros((1, state_dim))))
+
+
+if __name__ == '__main__':
+    run__numpy_actor()
@@ -156,7 +156,34 @@ class ActorSAC(nn.Module):
         return a_noise_tanh, log_prob.sum(1, keepdim=True)
 
 
-class ActorPPO(nn.Module):
+class GaussianPolicy(nn.Module):  # the log_prob of diagonal Gaussian policy, for ActorPPO and ActorCriticPPO
+    def __init__(self):
+        super(GaussianPolicy, self).__init__()
+        self.constant_pi = np.log(np.sqrt(2 * np.pi))
+        # self.net__log_std = nn.Parameter(torch.zeros(1, action_dim), requires_grad=True), built by subclass
+
+    def get__log_prob(self, a_mean, a_inp):  # for update_parameter
+        a_log_std = self.net__log_std.expand_as(a_mean)
+        a_std = a_log_std.exp()
+
+        # log_prob = -(a_log_std + (a_inp - a_mean).pow(2) / (2 * a_std.pow(2)) + np.log(2 * np.pi) * 0.5)
+        log_prob = -(a_log_std + self.constant_pi + ((a_mean - a_inp) / a_std).pow(2) * 0.5)
+        log_prob = log_prob.sum(1)
+        return log_prob
+
+    def get__a__log_prob(self, a_mean):  # for select action
+        a_log_std = self.net__log_std.expand_as(a_mean)
+        a_std = torch.exp(a_log_std)
+
+        a_noise = torch.normal(a_mean, a_std)
+
+        # log_prob = -(a_log_std + (a_noise - a_mean).pow(2) / (2 * a_std.pow(2)) + np.log(2 * np.pi) * 0.5)
+        log_prob = -(a_log_std + self.constant_pi + ((a_mean - a_noise) / a_std).pow(2) / 2)
+        log_prob = log_prob.sum(1)
+        return a_noise, log_prob
+
+
+class ActorPPO(GaussianPolicy):
     def __init__(self, action_dim, critic_dim, mid_dim):
         super(ActorPPO, self).__init__()
 
@@ -173,8 +200,6 @@ class ActorPPO(nn.Module):
         #     nn.Linear(mid_dim, 1),
         # )
 
-        self.constant_pi = np.log(np.sqrt(2 * np.pi))
-
         '''layer_norm'''
         layer_norm(self.net_action[0], std=1.0)
         layer_norm(self.net_action[2], std=1.0)
@@ -188,26 +213,6 @@ class ActorPPO(nn.Module):
     #     q = self.critic_fc(s)
     #     return q
 
-    def get__log_prob(self, a_mean, a_inp):  # for update_parameter
-        a_log_std = self.net__log_std.expand_as(a_mean)
-        a_std = a_log_std.exp()
-
-        # log_prob = -(a_log_std + (a_inp - a_mean).pow(2) / (2 * a_std.pow(2)) + np.log(2 * np.pi) * 0.5)
-        log_prob = -(a_log_std + self.constant_pi + (a_mean - a_inp) / a_std).pow(2) * 0.5
-        log_prob = log_prob.sum(1)
-        return log_prob
-
-    def get__a__log_prob(self, a_mean):  # for select action
-        a_log_std = self.net__log_std.expand_as(a_mean)
-        a_std = torch.exp(a_log_std)
-
-        a_noise = torch.normal(a_mean, a_std)
-
-        # log_prob = -(a_log_std + (a_noise - a_mean).pow(2) / (2 * a_std.pow(2)) + np.log(2 * np.pi) * 0.5)
-        log_prob = -(a_log_std + self.constant_pi + ((a_mean - a_noise) / a_std).pow(2) / 2)
-        log_prob = log_prob.sum(1)
-        return a_noise, log_prob
-
 
 class CriticAdvantage(nn.Module):  # 2020-05-05 fix bug
     def __init__(self, state_dim, mid_dim):
@@ -227,6 +232,37 @@ class CriticAdvantage(nn.Module):  # 2020-05-05 fix bug
         return q
 
 
+class ActorCriticPPO(GaussianPolicy):  # shared trunk of ActorPPO and CriticAdvantage, AgentPPO(use_shared_trunk=True)
+    def __init__(self, state_dim, action_dim, mid_dim):
+        super(ActorCriticPPO, self).__init__()
+
+        self.net_trunk = nn.Sequential(
+            nn.Linear(state_dim, mid_dim), HardSwish(),
+            nn.Linear(mid_dim, mid_dim), HardSwish(),
+        )
+        self.net_action = nn.Linear(mid_dim, action_dim)
+        self.net_value = nn.Linear(mid_dim, 1)
+        self.net__log_std = nn.Parameter(torch.zeros(1, action_dim), requires_grad=True)
+
+        '''layer_norm'''
+        layer_norm(self.net_trunk[0], std=1.0)
+        layer_norm(self.net_trunk[2], std=1.0)
+        layer_norm(self.net_action, std=0.01)  # output layer for action
+        layer_norm(self.net_value, std=1.0)  # output layer for value
+
+    def forward(self, s):
+        a_mean = self.net_action(self.net_trunk(s))
+        return a_mean
+
+    def critic(self, s):
+        v = self.net_value(self.net_trunk(s))
+        return v
+
+    def get__a_mean__value(self, s):  # for update_parameter, one trunk forward for action mean and value
+        x = self.net_trunk(s)
+        return self.net_action(x), self.net_value(x).flatten()
+
+
 class QNetwork(nn.Module):  # class AgentQLearning
     def __init__(self, state_dim, action_dim, mid_dim):
         super(QNetwork, self).__init__()
@@ -291,12 +327,20 @@ class ActorCritic(nn.Module):  # class AgentIntelAC
 
     def forward(self, s, noise_std=0.0):  # actor
         s_ = self.enc_s(s)
-        a_ = self.net(s_)
-        a = self.dec_a(a_)
+        a = self.actor_(s_)
         return a if noise_std == 0.0 else self.add_noise(a, noise_std)
 
     def critic(self, s, a):
         s_ = self.enc_s(s)
+        q = self.critic_(s_, a)
+        return q
+
+    def actor_(self, s_):  # actor, reuse the state encoding s_ = self.enc_s(s)
+        a_ = self.net(s_)
+        a = self.dec_a(a_)
+        return a
+
+    def critic_(self, s_, a):  # critic, reuse the state encoding s_ = self.enc_s(s)
         a_ = self.enc_a(a)
         q_ = self.net(s_ + a_)
         q = self.dec_q(q_)
@@ -304,25 +348,75 @@ class ActorCritic(nn.Module):  # class AgentIntelAC
 
     def next__q_a(self, s, s_next, noise_std):
         s_ = self.enc_s(s)
-        a_ = self.net(s_)
-        a = self.dec_a(a_)
-
-        '''q_target (without noise)'''
-        a_ = self.enc_a(a)
         s_next_ = self.enc_s(s_next)
-        q_target0_ = self.net(s_next_ + a_)
-        q_target0 = self.dec_q(q_target0_)
+        return self.next__q_a_(s_, s_next_, noise_std)
 
-        '''q_target (with noise)'''
+    def next__q_a_(self, s_, s_next_, noise_std):  # reuse the state encoding, for target network
+        a = self.actor_(s_)
         a_noise = self.add_noise(a, noise_std)
-        a_noise_ = self.enc_a(a_noise)
-        q_target1_ = self.net(s_next_ + a_noise_)
+
+        '''q_target (without noise) and q_target (with noise) in one batch'''
+        s_next_2 = torch.cat((s_next_, s_next_), dim=0)
+        a_2_ = self.enc_a(torch.cat((a, a_noise), dim=0))
+        q_target0_, q_target1_ = self.net(s_next_2 + a_2_).chunk(2, dim=0)
+
+        # dec_q once per q_target: each call of spectral_norm runs one power iteration (the same as two critic_())
+        q_target0 = self.dec_q(q_target0_)
         q_target1 = self.dec_q(q_target1_)
 
         q_target = (q_target0 + q_target1) * 0.5
         return q_target, a
 
 
+class ActorDPGStack(nn.Module):  # K ActorDPG with stacked parameters, train K random seeds in one process
+    def __init__(self, stack_num, state_dim, action_dim, mid_dim):
+        super(ActorDPGStack, self).__init__()
+        self.net = MLPStack(stack_num, (state_dim, mid_dim, mid_dim, action_dim))
+
+    def forward(self, s, noise_std=0.0, k=None):  # s.shape == (stack_num, batch_size, state_dim)
+        a = self.net(s, k).tanh()  # k: only compute the k-th actor, s.shape == (batch_size, state_dim)
+        return a if noise_std == 0.0 else self.add_noise(a, noise_std)
+
+    @staticmethod
+    def add_noise(action, noise_std):  # noise_std can be a tensor, different noise_std for each actor
+        normal_noise = (torch.randn_like(action) * noise_std).clamp_(-0.5, 0.5)
+        a_noise = (action + normal_noise).clamp_(-1.0, 1.0)
+        return a_noise
+
+    def get_state_dict_k(self, k):  # the state_dict of ActorDPG
+        return self.net.get_state_dict_k(k, prefix='net.')
+
+    def load_state_dict_k(self, k, state_dict):  # load the state_dict of ActorDPG
+        self.net.load_state_dict_k(k, state_dict, prefix='net.')
+
+
+class CriticTwinStack(nn.Module):  # K CriticTwin with stacked parameters
+    def __init__(self, stack_num, state_dim, action_dim, mid_dim):
+        super(CriticTwinStack, self).__init__()
+        self.net1 = MLPStack(stack_num, (state_dim + action_dim, mid_dim, mid_dim, 1))
+        self.net2 = MLPStack(stack_num, (state_dim + action_dim, mid_dim, mid_dim, 1))
+
+    def forward(self, state, action, k=None):
+        x = torch.cat((state, action), dim=-1)
+        q_value = self.net1(x, k)
+        return q_value
+
+    def get__q1_q2(self, state, action, k=None):
+        x = torch.cat((state, action), dim=-1)
+        q_value1 = self.net1(x, k)
+        q_value2 = self.net2(x, k)
+        return q_value1, q_value2
+
+    def get_state_dict_k(self, k):  # the state_dict of CriticTwin
+        state_dict = self.net1.get_state_dict_k(k, prefix='net1.')
+        state_dict.update(self.net2.get_state_dict_k(k, prefix='net2.'))
+        return state_dict
+
+    def load_state_dict_k(self, k, state_dict):  # load the state_dict of CriticTwin
+        self.net1.load_state_dict_k(k, state_dict, prefix='net1.')
+        self.net2.load_state_dict_k(k, state_dict, prefix='net2.')
+
+
 """utils"""
 
 
@@ -337,7 +431,7 @@ def build_actor_network(state_dim, action_dim, mid_dim, use_dense):
 
     if use_dense:  # use DenseNet (replace all conv2d layers into linear layers)
         nn_list.extend([DenseNet(mid_dim),
-                        nn.Linear(mid_dim * 4, 1), ])
+                        nn.Linear(mid_dim * 4, action_dim), nn.Tanh(), ])
     else:
         nn_list.extend([nn.Linear(mid_dim, mid_dim), nn.ReLU(),
                         nn.Linear(mid_dim, action_dim), nn.Tanh(), ])
@@ -424,3 +518,53 @@ class HardSwish(nn.Module):
 
     def forward(self, x):
         return self.relu6(x + 3.) / 6. * x
+
+
+class MLPStack(nn.Module):  # K independent MLP (Linear, ReLU, ..., Linear), compute them in batched matmul
+    def __init__(self, stack_num, dims):
+        super(MLPStack, self).__init__()
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for in_dim, out_dim in zip(dims[:-1], dims[1:]):
+            bound = 1 / np.sqrt(in_dim)  # the same as the default initialization of nn.Linear
+            self.weights.append(nn.Parameter(torch.empty(stack_num, in_dim, out_dim).uniform_(-bound, bound)))
+            self.biases.append(nn.Parameter(torch.empty(stack_num, 1, out_dim).uniform_(-bound, bound)))
+
+    def forward(self, x, k=None):
+        last_i = len(self.weights) - 1
+        for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            if k is None:  # x.shape == (stack_num, batch_size, in_dim)
+                x = torch.baddbmm(bias, x, weight)
+            else:  # only compute the k-th MLP, x.shape == (batch_size, in_dim)
+                x = torch.addmm(bias[k], x, weight[k])
+            if i < last_i:
+                x = torch.relu(x)
+        return x
+
+    def get_state_dict_k(self, k, prefix):  # the same keys as nn.Sequential(Linear, ReLU, ..., Linear)
+        state_dict = dict()
+        for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            state_dict['{}{}.weight'.format(prefix, i * 2)] = weight[k].t().detach().clone()
+            state_dict['{}{}.bias'.format(prefix, i * 2)] = bias[k, 0].detach().clone()
+        return state_dict
+
+    def load_state_dict_k(self, k, state_dict, prefix):
+        with torch.no_grad():
+            for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+                weight[k] = state_dict['{}{}.weight'.format(prefix, i * 2)].t()
+                bias[k, 0] = state_dict['{}{}.bias'.format(prefix, i * 2)]
+
+
+class ActorScript(nn.Module):  # eval-mode actor with baked state normalization, for TorchScript export
+    def __init__(self, net, state_mean, state_std, clip, is_discrete):
+        super(ActorScript, self).__init__()
+        self.net = net  # nn.Sequential, the network output without explore noise
+        self.register_buffer('state_mean', torch.as_tensor(state_mean, dtype=torch.float32))
+        self.register_buffer('state_std', torch.as_tensor(state_std, dtype=torch.float32))
+        self.clip = float(clip)
+        self.is_discrete = is_discrete
+
+    def forward(self, s):
+        s = ((s - self.state_mean) / self.state_std).clamp(-self.clip, self.clip)
+        a = self.net(s)
+        return a.argmax(dim=1) if self.is_discrete else a
@@ -6,8 +6,10 @@ import torch
 import numpy as np
 
 from AgentZoo import Recorder
-from AgentZoo import BufferArray, BufferListPPO, initial_exploration
-from AgentZoo import AutoNormalization  # for PPO
+from AgentZoo import BufferArray, BufferArrayPPO, initial_exploration
+from AgentZoo import AutoNormalization, SharedNormalization  # for PPO
+from AgentZoo import BufferArrayStack, AgentStackView, initial_exploration_stack  # for AgentTD3Stack
+from AgentInference import export_torch_script
 
 """
 2019-07-01 Zen4Jia1Hao2, GitHub: YonV1943 DL_RL_Zoo RL
@@ -36,6 +38,10 @@ class Arguments:  # default working setting and hyper-parameter
         self.repeat_times = 1  # Two-time Update Rule (TTUR)
         self.reward_scale = 2 ** 0  # an approximate target reward usually be closed to 256
         self.gamma = 0.99  # discount factor of future rewards
+        self.use_bf16 = False  # bfloat16 autocast training on CPU, off-policy Actor-Critic agents (opt-in)
+        self.use_compile = False  # torch.compile the loss functions, fall back to eager mode (opt-in)
+        self.record_gif = False  # Recorder records a GIF of the best actor in a background process (opt-in)
+        self.env_num = 1  # PPO collects in env_num envs with one batched forward per step (vectorized rollout)
 
         self.gpu_id = 0
         self.random_seed = 19430
@@ -53,17 +59,20 @@ class Arguments:  # default working setting and hyper-parameter
         np.random.seed(self.random_seed)
         torch.manual_seed(self.random_seed)
         torch.set_default_dtype(torch.float32)
-        torch.set_num_threads(8)
+        torch.set_num_threads(get_num_threads())  # see plan_cpu_threads() of run__multi_process()
 
 
 def train_agent__off_policy(
         class_agent, net_dim, batch_size, repeat_times, gamma, reward_scale, cwd,
-        env_name, max_step, max_memo, max_epoch, **_kwargs):  # 2020-06-01
+        env_name, max_step, max_memo, max_epoch, use_bf16=False, use_compile=False, **_kwargs):  # 2020-06-01
     env = gym.make(env_name)
     state_dim, action_dim, max_action, target_reward, is_discrete = get_env_info(env, is_print=False)
 
     '''init'''
     agent = class_agent(state_dim, action_dim, net_dim)  # training agent
+    agent.use_bf16 = use_bf16  # mixed precision (bfloat16) on CPU
+    if use_compile:
+        agent.init_compiled_step()
     agent.state = env.reset()
     buffer = BufferArray(max_memo, state_dim, action_dim=1 if is_discrete else action_dim)  # experiment replay buffer
     recorder = Recorder(agent, max_step, max_action, target_reward, env_name, **_kwargs)  # unnecessary
@@ -105,10 +114,66 @@ def train_agent__off_policy(
     draw_plot_with_npy(cwd, train_time)
 
 
+def train_agent__stack(
+        class_agent, net_dim, batch_size, repeat_times, gamma, reward_scale, cwd,
+        env_name, max_step, max_memo, max_epoch, random_seed, stack_num=4, **_kwargs):
+    """
+    Train K (stack_num) agents with different random seeds in one process, instead of run__multi_process().
+    The K agents (such as AgentTD3Stack) store their parameters in stacked tensors, so that the forward,
+    backward and Adam of K agents run in batched operators. The result of the k-th agent saves in cwd/seed_k
+    """
+    env_list = [gym.make(env_name) for _ in range(stack_num)]
+    for k, env in enumerate(env_list):
+        env.seed(random_seed + k)
+    state_dim, action_dim, max_action, target_reward, is_discrete = get_env_info(env_list[0], is_print=False)
+    assert not is_discrete  # AgentTD3Stack, continuous action space
+
+    '''init'''
+    agent = class_agent(state_dim, action_dim, net_dim, stack_num)  # training agent
+    buffer = BufferArrayStack(stack_num, max_memo, state_dim, action_dim)  # K replay buffer, sample in one gather
+    cwd_list = ['{}/seed_{}'.format(cwd, k) for k in range(stack_num)]
+    [os.makedirs(cwd_k, exist_ok=True) for cwd_k in cwd_list]
+    recorders = [Recorder(AgentStackView(agent, k), max_step, max_action, target_reward, env_name, **_kwargs)
+                 for k in range(stack_num)]
+
+    '''loop'''
+    with torch.no_grad():  # update replay buffer
+        rewards_list, steps_list = initial_exploration_stack(
+            env_list, buffer, max_step, max_action, reward_scale, gamma, action_dim)
+    agent.state = np.stack([env.reset() for env in env_list])
+    for recorder, rewards, steps in zip(recorders, rewards_list, steps_list):
+        recorder.show_reward(rewards, steps, loss_a=0, loss_c=0)
+
+    is_solved_list = [False, ] * stack_num
+    try:
+        for epoch in range(max_epoch):
+            with torch.no_grad():  # for saving the GPU buffer
+                rewards_list, steps_list = agent.update_buffer(
+                    env_list, buffer, max_step, max_action, reward_scale, gamma)
+
+            buffer.init_before_sample()
+            loss_a, loss_c = agent.update_parameters(
+                buffer, max_step, batch_size, repeat_times)  # the average loss of K agents
+
+            with torch.no_grad():  # for saving the GPU buffer
+                for k, recorder in enumerate(recorders):
+                    recorder.show_reward(rewards_list[k], steps_list[k], loss_a, loss_c)
+                    is_solved_list[k] = is_solved_list[k] or recorder.check_reward(cwd_list[k], loss_a, loss_c)
+            if all(is_solved_list):
+                break
+    except KeyboardInterrupt:
+        print("| raise KeyboardInterrupt and break training loop")
+
+    for recorder, cwd_k in zip(recorders, cwd_list):
+        train_time = recorder.print_and_save_npy(env_name, cwd_k)
+        draw_plot_with_npy(cwd_k, train_time)
+
+
 def train_agent_ppo(
         class_agent, batch_size, repeat_times, gamma, reward_scale, cwd,
-        env_name, max_step, net_dim, max_memo, max_epoch, **_kwargs):  # 2020-0430
+        env_name, max_step, net_dim, max_memo, max_epoch, env_num=1, state_norm=None, **_kwargs):  # 2020-0430
     env = gym.make(env_name)
+    env_list = [env, ] + [gym.make(env_name) for _ in range(env_num - 1)]  # for update_buffer_ppo_vec()
     state_dim, action_dim, max_action, target_reward, is_discrete = get_env_info(env, is_print=False)
 
     '''default hyper-parameters for on-policy RL algorithm PPO
@@ -125,20 +190,25 @@ def train_agent_ppo(
     '''init'''
     agent = class_agent(state_dim, action_dim, net_dim)
 
-    buffer = BufferListPPO()  # on policy algorithm. Generalization Advantage Estimate. ICLR. 2016.
-    state_norm = AutoNormalization((state_dim,), clip=6.0)  # on policy algorithm can do normalization for state
+    buffer = BufferArrayPPO(max_memo + max_step * env_num, state_dim, action_dim)  # on policy algorithm, GAE
+    if state_norm is None:  # SharedNormalization: share the statistics with the collectors in other processes
+        state_norm = AutoNormalization((state_dim,), clip=6.0)  # on policy algorithm can do normalization for state
 
     recorder = Recorder(agent, max_step, max_action, target_reward, env_name,
                         state_norm=state_norm, **_kwargs)
     try:
         for epoch in range(max_epoch):
             # on policy algorithm refresh replay buffer for each parameters update
-            buffer.storage = list()
+            buffer.empty_memories()
 
             # update replay buffer by interact with environment
             with torch.no_grad():  # for saving the GPU buffer
-                rewards, steps = agent.update_buffer_ppo(
-                    env, buffer, max_step, max_memo, max_action, reward_scale, gamma, state_norm)
+                if env_num > 1:
+                    rewards, steps = agent.update_buffer_ppo_vec(
+                        env_list, buffer, max_step, max_memo, max_action, reward_scale, gamma, state_norm)
+                else:
+                    rewards, steps = agent.update_buffer_ppo(
+                        env, buffer, max_step, max_memo, max_action, reward_scale, gamma, state_norm)
 
             # update network parameters by random sampling buffer for gradient descent
             loss_a, loss_c = agent.update_parameters_ppo(
@@ -160,6 +230,7 @@ def train_agent_ppo(
 
     if is_solved:
         agent.save_or_load_model(cwd, is_save=True)
+        export_torch_script(agent.act, '{}/actor_script.pt'.format(cwd), state_norm)  # see TorchScriptActor
     draw_plot_with_npy(cwd, train_time)
 
 
@@ -466,12 +537,144 @@ def run__dqn(gpu_id, cwd='RL_DQN'):
     train_agent_discrete(**vars(args))
 
 
-def run__multi_process(target_func, gpu_tuple=(0, 1), cwd='AC_Methods_MP'):
+def run__multi_seed(gpu_id, cwd='AC_TD3_Stack'):
+    from AgentZoo import AgentTD3Stack
+
+    args = Arguments(AgentTD3Stack)
+    args.gpu_id = gpu_id
+    args.stack_num = 4  # train 4 random seeds in one process, instead of run__multi_process()
+
+    args.env_name = "LunarLanderContinuous-v2"
+    args.cwd = './{}/LL_{}'.format(cwd, gpu_id)
+    args.init_for_training()
+    train_agent__stack(**vars(args))
+
+
+def run__tournament(cwd_list, env_name="LunarLanderContinuous-v2", eva_size=2 ** 4, max_step=2 ** 10):
+    """
+    Evaluate the actor.pth of M runs (ActorDPG, ActorDL without DenseNet, ActorSAC) on the same seeded episodes.
+    cwd_list: such as ['AC_TD3/LL_0', 'AC_TD3/LL_1', 'AC_SAC/LL_0']
+    """
+    from AgentNetwork import ActorDPGStack
+    from AgentZoo import get_eva_reward_stack
+
+    env = gym.make(env_name)
+    state_dim, action_dim, max_action, target_reward, is_discrete = get_env_info(env, is_print=False)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    state_dicts = list()
+    for cwd in cwd_list:
+        state_dict = torch.load('{}/actor.pth'.format(cwd), map_location=lambda storage, loc: storage)
+        state_dict = {key.replace('net__mean.', 'net.4.'): value for key, value in state_dict.items()  # ActorSAC
+                      if not key.startswith('net__std_log.')}
+        state_dicts.append(state_dict)
+
+    net_dim = state_dicts[0]['net.0.weight'].shape[0]
+    act_stack = ActorDPGStack(len(cwd_list), state_dim, action_dim, net_dim).to(device)
+    for k, state_dict in enumerate(state_dicts):
+        act_stack.load_state_dict_k(k, state_dict)
+    act_stack.eval()
+
+    env_lists = [[gym.make(env_name) for _ in range(eva_size)] for _ in cwd_list]
+    rewards = get_eva_reward_stack(act_stack, env_lists, max_step, max_action)
+
+    r_avg = rewards.mean(axis=1)
+    r_std = rewards.std(axis=1)
+    print("{:4} {:32} |{:>8} {:>8}".format('Rank', 'cwd', 'r_avg', 'r_std'))
+    for rank, k in enumerate(np.argsort(-r_avg)):
+        print("{:4} {:32} |{:8.2f} {:8.2f}".format(rank + 1, cwd_list[k], r_avg[k], r_std[k]))
+    return rewards
+
+
+def get_num_threads(default=8):  # OMP_NUM_THREADS is set by apply_cpu_plan() in multiprocessing
+    return int(os.environ.get('OMP_NUM_THREADS', default))
+
+
+def plan_cpu_threads(process_num, cpu_ids=None):
+    """
+    Assign each process a disjoint CPU set (affinity) and the thread number of torch, to avoid oversubscription.
+    cpu_ids: the available CPUs, default: the affinity of this process
+    return: [(cpu_ids, intra_op_threads, inter_op_threads), ] * process_num
+    """
+    if cpu_ids is None:
+        cpu_ids = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else range(os.cpu_count())
+    cpu_ids = list(cpu_ids)
+
+    if process_num <= len(cpu_ids):
+        cpu_sets = [[int(i) for i in ids] for ids in np.array_split(cpu_ids, process_num)]
+    else:  # more processes than CPUs, each process gets one CPU
+        cpu_sets = [[cpu_ids[i % len(cpu_ids)]] for i in range(process_num)]
+    return [(cpu_set, len(cpu_set), 1) for cpu_set in cpu_sets]  # the MLP of agent has no parallel branch
+
+
+def apply_cpu_plan(cpu_plan):  # call it at the start of the process
+    cpu_ids, intra_op_threads, inter_op_threads = cpu_plan
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpu_ids)
+    os.environ['OMP_NUM_THREADS'] = str(intra_op_threads)
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError:  # it can only be set once, before any inter-op parallel work
+        pass
+
+
+def save_cpu_plan(cwd, cpu_plans, names):
+    with open('{}/cpu_plan.txt'.format(cwd), 'w') as f:
+        for name, (cpu_ids, intra_op_threads, inter_op_threads) in zip(names, cpu_plans):
+            f.write("{}: cpu_ids {}, intra_op_threads {}, inter_op_threads {}\n".format(
+                name, cpu_ids, intra_op_threads, inter_op_threads))
+
+
+def process__cpu_plan(cpu_plan, target_func, *args):
+    apply_cpu_plan(cpu_plan)
+    return target_func(*args)
+
+
+def run__multi_process(target_func, gpu_tuple=(0, 1), cwd='AC_Methods_MP', use_cpu_plan=True):
     os.makedirs(cwd, exist_ok=True)  # all the files save in here
 
     '''run in multiprocessing'''
     import multiprocessing as mp
-    processes = [mp.Process(target=target_func, args=(gpu_id, cwd)) for gpu_id in gpu_tuple]
+    if use_cpu_plan:
+        cpu_plans = plan_cpu_threads(len(gpu_tuple))
+        save_cpu_plan(cwd, cpu_plans, names=['gpu_id {}'.format(gpu_id) for gpu_id in gpu_tuple])
+        processes = [mp.Process(target=process__cpu_plan, args=(cpu_plan, target_func, gpu_id, cwd))
+                     for cpu_plan, gpu_id in zip(cpu_plans, gpu_tuple)]
+    else:
+        processes = [mp.Process(target=target_func, args=(gpu_id, cwd)) for gpu_id in gpu_tuple]
+    [process.start() for process in processes]
+    [process.join() for process in processes]
+
+
+def process__ppo_shared_norm(gpu_id, cwd, state_norm):
+    from AgentZoo import AgentPPO
+    args = Arguments(AgentPPO)
+
+    args.gpu_id = gpu_id
+    args.random_seed += gpu_id
+    args.max_memo = 2 ** 11
+    args.repeat_times = 2 ** 3
+    args.batch_size = 2 ** 8
+
+    args.env_name = "LunarLanderContinuous-v2"
+    args.cwd = './{}/LL_{}'.format(cwd, gpu_id)
+    args.init_for_training()
+    train_agent_ppo(**vars(args), state_norm=state_norm)
+
+
+def run__ppo_shared_norm(gpu_tuple=(0, 1), cwd='AC_PPO_SharedNorm'):
+    os.makedirs(cwd, exist_ok=True)
+    env = gym.make("LunarLanderContinuous-v2")
+    state_dim = env.observation_space.shape[0]
+    state_norm = SharedNormalization((state_dim,), clip=6.0)  # one normalizer for the PPO of all processes
+
+    import multiprocessing as mp
+    cpu_plans = plan_cpu_threads(len(gpu_tuple))
+    save_cpu_plan(cwd, cpu_plans, names=['gpu_id {}'.format(gpu_id) for gpu_id in gpu_tuple])
+    processes = [mp.Process(target=process__cpu_plan,
+                            args=(cpu_plan, process__ppo_shared_norm, gpu_id, cwd, state_norm))
+                 for cpu_plan, gpu_id in zip(cpu_plans, gpu_tuple)]
     [process.start() for process in processes]
     [process.join() for process in processes]
 
@@ -540,7 +743,7 @@ def process__workers(gpu_id, root_cwd, q_aggr, q_dist, args,
     np.random.seed(random_seed)
     torch.manual_seed(random_seed)
     torch.set_default_dtype(torch.float32)
-    torch.set_num_threads(8)
+    torch.set_num_threads(get_num_threads())  # see plan_cpu_threads() of run__multi_workers()
 
     env = gym.make(env_name)
     is_solved = False
@@ -619,9 +822,15 @@ def run__multi_workers(gpu_tuple=(0, 1), root_cwd='AC_Methods_MP'):
     queue_aggr = mp.Queue(maxsize=workers_num)  # queue of aggregation
     queues_dist = [mp.Queue(maxsize=args.max_step) for _ in range(workers_num)]  # queue of distribution
 
-    processes = [mp.Process(target=process__buffer, args=(queue_aggr, queues_dist, args))]
-    processes.extend([mp.Process(target=process__workers, args=(gpu_id, root_cwd, queue_aggr, queue_dist, args))
-                      for gpu_id, queue_dist in zip(gpu_tuple, queues_dist)])
+    os.makedirs(root_cwd, exist_ok=True)
+    cpu_plans = plan_cpu_threads(workers_num + 1)
+    save_cpu_plan(root_cwd, cpu_plans, names=['process__buffer'] + ['gpu_id {}'.format(i) for i in gpu_tuple])
+
+    processes = [mp.Process(target=process__cpu_plan,
+                            args=(cpu_plans[0], process__buffer, queue_aggr, queues_dist, args))]
+    processes.extend([mp.Process(target=process__cpu_plan,
+                                 args=(cpu_plan, process__workers, gpu_id, root_cwd, queue_aggr, queue_dist, args))
+                      for cpu_plan, gpu_id, queue_dist in zip(cpu_plans[1:], gpu_tuple, queues_dist)])
 
     [process.start() for process in processes]
     # [process.join() for process in processes]
@@ -4,11 +4,11 @@ import gym
 import torch
 import torch.nn as nn
 import numpy as np
-import numpy.random as rd
 
 from AgentRun import Recorder  # for train_agent_ppo()
 from AgentRun import Arguments  # for run__ppo()
 from AgentRun import get_env_info, draw_plot_with_npy  # for run__ppo()
+from AgentZoo import get_reverse_scan, get_minibatches  # for update_parameter_ppo()
 
 '''AgentNetwork'''
 
@@ -113,6 +113,7 @@ class AgentPPO:
         self.loss_c_sum = 0.0
         self.loss_coeff_value = 0.5
         self.loss_coeff_entropy = 0.02  # 0.01
+        self.bootstrap_truncated = False  # bootstrap the value of next state for the episodes truncated by max_step
 
     def inactive_in_env_ppo(self, env, max_step, max_memo, max_action, running_state):
         # step1: perform current policy to collect trajectories
@@ -129,10 +130,9 @@ class AgentPPO:
 
             state = running_state(state)  # if state_norm:
             for t in range(max_step):
-                actions, log_probs, q_value = self.select_actions(state[np.newaxis], explore_noise=True)
+                actions, log_probs = self.select_actions(state[np.newaxis], explore_noise=True)
                 action = actions[0]
                 log_prob = log_probs[0]
-                q_value = q_value[0]
 
                 next_state, reward, done, _ = env.step(action * max_action)
                 reward_sum += reward
@@ -141,10 +141,12 @@ class AgentPPO:
                 mask = 0 if done else 1
 
                 # memory.push(state, q_value, action, log_prob, mask, next_state, reward)
-                memory.push(state, q_value, action, log_prob, mask, reward)
+                memory.push(state, action, log_prob, mask, reward)
 
                 if done:
                     break
+                if t == max_step - 1:  # the episode is truncated, for bootstrap_truncated
+                    memory.truncated.append((len(memory) - 1, next_state))
 
                 state = next_state
             rewards.append(reward_sum)
@@ -160,48 +162,41 @@ class AgentPPO:
         num_epoch = 10
 
         all_batch = memory.sample()
-        max_memo = len(memory)
 
         all_reward = torch.tensor(all_batch.reward, dtype=torch.float32, device=self.device)
-        all_value = torch.tensor(all_batch.value, dtype=torch.float32, device=self.device)
         all_mask = torch.tensor(all_batch.mask, dtype=torch.float32, device=self.device)
-        all_action = torch.tensor(all_batch.action, dtype=torch.float32, device=self.device)
-        all_state = torch.tensor(all_batch.state, dtype=torch.float32, device=self.device)
+        all_action = torch.tensor(np.array(all_batch.action), dtype=torch.float32, device=self.device)
+        all_state = torch.tensor(np.array(all_batch.state), dtype=torch.float32, device=self.device)
         all_log_prob = torch.tensor(all_batch.log_prob, dtype=torch.float32, device=self.device)
-        # next_state not use?
 
         '''calculate prev (return, value, advantage)'''
-        all_deltas = torch.empty(max_memo, dtype=torch.float32, device=self.device)
-        all_returns = torch.empty(max_memo, dtype=torch.float32, device=self.device)
-        all_advantages = torch.empty(max_memo, dtype=torch.float32, device=self.device)
-
-        prev_return = 0
-        prev_value = 0
-        prev_advantage = 0
-        for i in range(max_memo - 1, -1, -1):
-            all_deltas[i] = all_reward[i] + gamma * prev_value * all_mask[i] - all_value[i]
-            all_returns[i] = all_reward[i] + gamma * prev_return * all_mask[i]
-            # ref: https://arxiv.org/pdf/1506.02438.pdf (generalization advantage estimate)
-            all_advantages[i] = all_deltas[i] + gamma * lamda * prev_advantage * all_mask[i]
-
-            prev_return = all_returns[i]
-            prev_value = all_value[i]
-            prev_advantage = all_advantages[i]
+        with torch.no_grad():  # the values of the whole rollout in one batched forward, instead of in each env step
+            all_value = self.act.critic(all_state).flatten()
+        all_next_value = torch.cat((all_value[1:], all_value.new_zeros(1)))  # prev_value = 0 at the end
+        all_bootstrap = torch.zeros_like(all_reward)  # gamma * value(next_state) of the truncated episodes
+
+        if self.bootstrap_truncated and memory.truncated:
+            indices, next_states = zip(*memory.truncated)
+            indices = list(indices)
+            with torch.no_grad():
+                next_states = torch.tensor(np.array(next_states), dtype=torch.float32, device=self.device)
+                all_bootstrap[indices] = self.act.critic(next_states).flatten() * gamma
+            all_mask[indices] = 0  # the next step in memory belongs to the next episode
+
+        # ref: https://arxiv.org/pdf/1506.02438.pdf (generalization advantage estimate)
+        all_deltas = all_reward + gamma * all_next_value * all_mask + all_bootstrap - all_value
+        all_returns = get_reverse_scan(all_reward + all_bootstrap, gamma * all_mask)
+        all_advantages = get_reverse_scan(all_deltas, gamma * lamda * all_mask)
 
         all_advantages = (all_advantages - all_advantages.mean()) / (all_advantages.std() + 1e-6)  # if advantage_norm:
 
         '''mini all_batch sample'''
         loss_total = loss_value = None
 
-        for i_epoch in range(int(num_epoch * max_memo / batch_size)):
-            # sample from current all_batch
-            ind = rd.choice(max_memo, batch_size, replace=False)
-            states = all_state[ind]
-            actions = all_action[ind]
-            old_log_probs = all_log_prob[ind]
+        all_tensors = (all_state, all_action, all_log_prob, all_advantages, all_returns)
+        for states, actions, old_log_probs, advantages, returns in get_minibatches(all_tensors, batch_size, num_epoch):
+            # permutation-based minibatch epochs
             new_log_probs = self.act.get__log_prob(states, actions)
-            advantages = all_advantages[ind]
-            returns = all_returns[ind]
 
             new_values = self.act.critic(states).flatten()
 
@@ -240,10 +235,7 @@ class AgentPPO:
             a_noise = a_noise.cpu().data.numpy()
 
             log_prob = log_prob.cpu().data.numpy()
-
-            q_value = self.act.critic(states)
-            q_value = q_value.cpu().data.numpy()
-            return a_noise, log_prob, q_value
+            return a_noise, log_prob  # the values are computed in update_parameter_ppo()
 
     def save_or_load_model(self, mod_dir, is_save):
         act_save_path = '{}/actor.pth'.format(mod_dir)
@@ -271,8 +263,9 @@ class MemoryList:
         self.transition = namedtuple(
             'Transition',
             # ('state', 'value', 'action', 'log_prob', 'mask', 'next_state', 'reward')
-            ('state', 'value', 'action', 'log_prob', 'mask', 'reward')
+            ('state', 'action', 'log_prob', 'mask', 'reward')
         )
+        self.truncated = []  # [(index, next_state), ...] of the episodes truncated by max_step
 
     def push(self, *args):
         self.memory.append(self.transition(*args))
@@ -290,16 +283,29 @@ class RunningStat:
         self._M = np.zeros(shape)
         self._S = np.zeros(shape)
 
-    def push(self, x):
+    def push(self, x):  # one observation, x.shape == self.shape
         x = np.asarray(x)
-        # assert x.shape == self._M.shape
         self._n += 1
-        if self._n == 1:
-            self._M[...] = x
-        else:
-            pre_memo = self._M.copy()
-            self._M[...] = pre_memo + (x - pre_memo) / self._n
-            self._S[...] = self._S + (x - pre_memo) * (x - self._M)
+        delta = x - self._M
+        self._M += delta / self._n
+        self._S += delta * (x - self._M)
+
+    def push_batch(self, xs):  # a batch of observations, xs.shape == (batch_size, *self.shape)
+        xs = np.asarray(xs)
+        if len(xs):
+            mean = xs.mean(axis=0)
+            self.push_stat(len(xs), mean, np.square(xs - mean).sum(axis=0))
+
+    def merge(self, other):  # merge the statistics of another RunningStat, such as the one of another worker
+        if other.n:
+            self.push_stat(other.n, other.mean, other._S)
+
+    def push_stat(self, n, mean, sum_sq):  # parallel Welford (Chan et al.), sum_sq: sum of squared deviations
+        pre_n = self._n
+        self._n = pre_n + n
+        delta = mean - self._M
+        self._M += delta * (n / self._n)
+        self._S += sum_sq + np.square(delta) * (pre_n * n / self._n)
 
     @property
     def n(self):
@@ -335,9 +341,12 @@ class ZFilter:
 
         self.rs = RunningStat(shape)
 
-    def __call__(self, x, update=True):
+    def __call__(self, x, update=True):  # x can be a batch of observations, x.shape == (batch_size, *shape)
         if update:
-            self.rs.push(x)
+            if np.ndim(x) > len(self.rs.shape):
+                self.rs.push_batch(x)
+            else:
+                self.rs.push(x)
         if self.demean:
             x = x - self.rs.mean
         if self.destd:
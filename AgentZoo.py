@@ -1,4 +1,5 @@
 import os
+import contextlib
 from time import time as timer
 
 import gym
@@ -12,7 +13,9 @@ from AgentNetwork import ActorDPG, Critic
 from AgentNetwork import ActorDL, CriticSN  # SN_AC
 from AgentNetwork import ActorCritic  # IntelAC
 from AgentNetwork import CriticTwin  # TD3, SAC
+from AgentNetwork import ActorDPGStack, CriticTwinStack  # TD3 (stacked K random seeds)
 from AgentNetwork import ActorPPO, CriticAdvantage  # PPO
+from AgentNetwork import ActorCriticPPO  # PPO (shared trunk)
 from AgentNetwork import ActorSAC  # SAC
 
 """
@@ -57,6 +60,7 @@ class AgentDDPG:  # DEMO (tutorial only, simplify, low effective)
         self.criterion = nn.MSELoss()
 
         '''training record'''
+        self.metrics = LossMetrics()  # accumulate loss on device, read by Recorder
         self.step_sum = 0
 
         '''extension'''
@@ -89,8 +93,7 @@ class AgentDDPG:  # DEMO (tutorial only, simplify, low effective)
         return (reward_sum,), (step_sum,)
 
     def update_parameters(self, memo, _max_step, batch_size, _update_gap):
-        loss_a_sum = 0.0
-        loss_c_sum = 0.0
+        self.metrics.reset()
 
         # Here, the step_sum we interact in env is equal to the parameters update times
         update_times = self.step_sum
@@ -105,7 +108,7 @@ class AgentDDPG:  # DEMO (tutorial only, simplify, low effective)
             """critic loss"""
             q_eval = self.cri(states, actions)
             critic_loss = self.criterion(q_eval, q_target)
-            loss_c_sum += critic_loss.item()
+            self.metrics.add('loss_c', critic_loss)
 
             self.cri_optimizer.zero_grad()
             critic_loss.backward()
@@ -114,7 +117,7 @@ class AgentDDPG:  # DEMO (tutorial only, simplify, low effective)
             """actor loss"""
             action_cur = self.act(states)
             actor_loss = -self.cri(states, action_cur).mean()  # update parameters by sample policy gradient
-            loss_a_sum += actor_loss.item()
+            self.metrics.add('loss_a', actor_loss)
 
             self.act_optimizer.zero_grad()
             actor_loss.backward()
@@ -123,9 +126,7 @@ class AgentDDPG:  # DEMO (tutorial only, simplify, low effective)
             self.soft_target_update(self.act_target, self.act)
             self.soft_target_update(self.cri_target, self.cri)
 
-        loss_a_avg = loss_a_sum / update_times
-        loss_c_avg = loss_c_sum / update_times
-        return loss_a_avg, loss_c_avg
+        return self.metrics.mean('loss_a'), self.metrics.mean('loss_c')
 
     def select_actions(self, states, explore_noise=0.0):  # CPU array to GPU tensor to CPU array
         states = torch.tensor(states, dtype=torch.float32, device=self.device)
@@ -157,6 +158,8 @@ class AgentDDPG:  # DEMO (tutorial only, simplify, low effective)
 
 
 class AgentBasicAC:  # DEMO (formal, basic Actor-Critic Methods, Policy Gradient)
+    use_bf16 = False  # bfloat16 autocast for forward and backward of act and cri on CPU, see autocast_bf16()
+
     def __init__(self, state_dim, action_dim, net_dim):
         use_densenet = False  # soft target update is conflict with use_densenet
         use_sn = False  # soft target update is conflict with use_sn (Spectral Normalization)
@@ -185,6 +188,8 @@ class AgentBasicAC:  # DEMO (formal, basic Actor-Critic Methods, Policy Gradient
         self.criterion = nn.SmoothL1Loss()
 
         '''training record'''
+        self.metrics = LossMetrics()  # accumulate loss on device, read by Recorder
+        self.fast_path = SingleStateInference(self.device)  # for select_action(), single state
         self.state = None  # env.reset()
         self.reward_sum = 0.0
         self.step_sum = 0
@@ -200,7 +205,7 @@ class AgentBasicAC:  # DEMO (formal, basic Actor-Critic Methods, Policy Gradient
         for t in range(max_step):
             '''inactive with environment'''
             explore_noise_temp = explore_noise if rd.rand() < explore_rate else 0
-            action = self.select_actions((self.state,), explore_noise_temp)[0]
+            action = self.select_action(self.state, explore_noise_temp)
             next_state, reward, done, _ = env.step(action * max_action)
 
             self.reward_sum += reward
@@ -223,12 +228,10 @@ class AgentBasicAC:  # DEMO (formal, basic Actor-Critic Methods, Policy Gradient
         return rewards, steps
 
     def update_parameters(self, buffer, max_step, batch_size, repeat_times):
-        policy_noise = 0.2  # standard deviation of policy noise
         update_freq = 2  # delay update frequency, for soft target update
         self.act.train()
 
-        loss_a_sum = 0.0
-        loss_c_sum = 0.0
+        self.metrics.reset()
 
         k = 1.0 + buffer.now_len / buffer.max_len
         batch_size_ = int(batch_size * k)
@@ -238,14 +241,9 @@ class AgentBasicAC:  # DEMO (formal, basic Actor-Critic Methods, Policy Gradient
             with torch.no_grad():
                 reward, mask, state, action, next_state = buffer.random_sample(batch_size_, self.device)
 
-                next_action = self.act_target(next_state, policy_noise)
-                q_target = self.cri_target(next_state, next_action)
-                q_target = reward + mask * q_target
-
             '''critic_loss'''
-            q_eval = self.cri(state, action)
-            critic_loss = self.criterion(q_eval, q_target)
-            loss_c_sum += critic_loss.item()
+            critic_loss = self.get_critic_loss(reward, mask, state, action, next_state)
+            self.metrics.add('loss_c', critic_loss)
 
             self.cri_optimizer.zero_grad()
             critic_loss.backward()
@@ -253,9 +251,10 @@ class AgentBasicAC:  # DEMO (formal, basic Actor-Critic Methods, Policy Gradient
 
             '''actor_loss'''
             if i % repeat_times == 0:
-                action_pg = self.act(state)  # policy gradient
-                actor_loss = -self.cri(state, action_pg).mean()  # policy gradient
-                loss_a_sum += actor_loss.item()
+                self.set_requires_grad(self.cri, False)  # skip the gradient of critic parameters
+                actor_loss = self.get_actor_loss(state)
+                self.set_requires_grad(self.cri, True)
+                self.metrics.add('loss_a', actor_loss)
 
                 self.act_optimizer.zero_grad()
                 actor_loss.backward()
@@ -268,20 +267,55 @@ class AgentBasicAC:  # DEMO (formal, basic Actor-Critic Methods, Policy Gradient
                 self.soft_target_update(self.act_target, self.act)  # soft target update
                 self.soft_target_update(self.cri_target, self.cri)  # soft target update
 
-        loss_a_avg = loss_a_sum / update_times
-        loss_c_avg = loss_c_sum / (update_times * repeat_times)
-        return loss_a_avg, loss_c_avg
+        return self.metrics.mean('loss_a'), self.metrics.mean('loss_c')
+
+    def get_critic_loss(self, reward, mask, state, action, next_state):
+        policy_noise = 0.2  # standard deviation of policy noise
+
+        with torch.no_grad():
+            next_action = self.act_target(next_state, policy_noise)
+            q_target = self.cri_target(next_state, next_action)
+            q_target = reward + mask * q_target
+
+        with autocast_bf16(self.use_bf16):
+            q_eval = self.cri(state, action)
+        critic_loss = self.criterion(q_eval.float(), q_target)
+        return critic_loss
+
+    def get_actor_loss(self, state):
+        with autocast_bf16(self.use_bf16):
+            action_pg = self.act(state)  # policy gradient
+            q_pg = self.cri(state, action_pg)
+        actor_loss = -q_pg.float().mean()  # policy gradient
+        return actor_loss
+
+    def init_compiled_step(self):  # optional, compile the loss function (forward and backward)
+        self.get_critic_loss = CompiledFunction(self.get_critic_loss)
+        self.get_actor_loss = CompiledFunction(self.get_actor_loss)
 
     def select_actions(self, states, explore_noise=0.0):  # CPU array to GPU tensor to CPU array
         states = torch.tensor(states, dtype=torch.float32, device=self.device)
         actions = self.act(states, explore_noise).cpu().data.numpy()
         return actions
 
+    def select_action(self, state, explore_noise=0.0):  # NOTICE! the action array is reused in next call
+        with inference_mode():
+            state = self.fast_path.set_state(state)
+            action = self.act(state, explore_noise)
+            return self.fast_path.get_output('action', action)
+
     @staticmethod
     def soft_target_update(target, source, tau=5e-3):
         for target_param, param in zip(target.parameters(), source.parameters()):
             target_param.data.copy_(tau * param.data + (1.0 - tau) * target_param.data)
 
+    @staticmethod
+    def set_requires_grad(net, requires_grad):
+        # actor_loss backward through critic only needs the gradient of activations, not critic parameters.
+        # autograd records the graph in forward pass, so it can set requires_grad=True before backward()
+        for param in net.parameters():
+            param.requires_grad_(requires_grad)
+
     def save_or_load_model(self, mod_dir, is_save):  # 2020-05-20
         act_save_path = '{}/actor.pth'.format(mod_dir)
         cri_save_path = '{}/critic.pth'.format(mod_dir)
@@ -331,6 +365,8 @@ class AgentSNAC(AgentBasicAC):
         self.criterion = nn.SmoothL1Loss()
 
         '''training record'''
+        self.metrics = LossMetrics()  # accumulate loss on device, read by Recorder
+        self.fast_path = SingleStateInference(self.device)  # for select_action(), single state
         self.state = None  # env.reset()
         self.reward_sum = 0.0
         self.step_sum = 0
@@ -341,12 +377,10 @@ class AgentSNAC(AgentBasicAC):
         self.rho = 0.5
 
     def update_parameters(self, buffer, max_step, batch_size, repeat_times):
-        policy_noise = 0.4  # standard deviation of policy noise
         update_freq = 2 ** 7  # delay update frequency, for hard target update
         self.act.train()
 
-        loss_a_sum = 0.0
-        loss_c_sum = 0.0
+        self.metrics.reset()
 
         k = 1.0 + buffer.now_len / buffer.max_len
         batch_size_ = int(batch_size * k)
@@ -356,19 +390,10 @@ class AgentSNAC(AgentBasicAC):
             with torch.no_grad():
                 reward, mask, state, action, next_state = buffer.random_sample(batch_size_, self.device)
 
-                next_a = self.act_target(next_state)
-                next_a_noisy = self.act_target.add_noise(next_a, policy_noise)
-                next_q = self.cri_target(next_state, next_a)
-                next_q_noisy = self.cri_target(next_state, next_a_noisy)
-                next_q_target = (next_q + next_q_noisy) * 0.5  # SNAC, more smooth and more stable q value
-                next_q_target = reward + mask * next_q_target
-
             '''critic_loss'''
-            q_eval = self.cri(state, action)
-            critic_loss = self.criterion(q_eval, next_q_target)
-            loss_c_tmp = critic_loss.item()
-            loss_c_sum += loss_c_tmp
-            self.loss_c_sum += loss_c_tmp  # extension
+            critic_loss = self.get_critic_loss(reward, mask, state, action, next_state)
+            self.metrics.add('loss_c', critic_loss)
+            self.loss_c_sum += critic_loss.detach()  # extension
 
             self.cri_optimizer.zero_grad()
             critic_loss.backward()
@@ -376,9 +401,10 @@ class AgentSNAC(AgentBasicAC):
 
             '''actor_loss'''
             if i % repeat_times == 0 and self.rho > 0.001:  # 2.6
-                actions_pg = self.act(state)  # policy gradient
-                actor_loss = -self.cri(state, actions_pg).mean()  # policy gradient
-                loss_a_sum += actor_loss.item()
+                self.set_requires_grad(self.cri, False)  # skip the gradient of critic parameters
+                actor_loss = self.get_actor_loss(state)
+                self.set_requires_grad(self.cri, True)
+                self.metrics.add('loss_a', actor_loss)
 
                 self.act_optimizer.zero_grad()
                 actor_loss.backward()
@@ -394,14 +420,28 @@ class AgentSNAC(AgentBasicAC):
                 self.cri_target.load_state_dict(self.cri.state_dict())  # hard target update
                 self.act_target.load_state_dict(self.act.state_dict())  # hard target update
 
-                rho = np.exp(-(self.loss_c_sum / update_freq) ** 2)
+                rho = np.exp(-(self.loss_c_sum.item() / update_freq) ** 2)
                 self.rho = (self.rho + rho) * 0.5
                 self.act_optimizer.param_groups[0]['lr'] = self.learning_rate * self.rho
                 self.loss_c_sum = 0.0
 
-        loss_a_avg = loss_a_sum / update_times
-        loss_c_avg = loss_c_sum / (update_times * repeat_times)
-        return loss_a_avg, loss_c_avg
+        return self.metrics.mean('loss_a'), self.metrics.mean('loss_c')
+
+    def get_critic_loss(self, reward, mask, state, action, next_state):
+        policy_noise = 0.4  # standard deviation of policy noise
+
+        with torch.no_grad():
+            next_a = self.act_target(next_state)
+            next_a_noisy = self.act_target.add_noise(next_a, policy_noise)
+            next_q = self.cri_target(next_state, next_a)
+            next_q_noisy = self.cri_target(next_state, next_a_noisy)
+            next_q_target = (next_q + next_q_noisy) * 0.5  # SNAC, more smooth and more stable q value
+            next_q_target = reward + mask * next_q_target
+
+        with autocast_bf16(self.use_bf16):
+            q_eval = self.cri(state, action)
+        critic_loss = self.criterion(q_eval.float(), next_q_target)
+        return critic_loss
 
 
 class AgentInterAC(AgentBasicAC):
@@ -424,6 +464,8 @@ class AgentInterAC(AgentBasicAC):
         self.criterion = nn.SmoothL1Loss()
 
         '''training record'''
+        self.metrics = LossMetrics()  # accumulate loss on device, read by Recorder
+        self.fast_path = SingleStateInference(self.device)  # for select_action(), single state
         self.state = None  # env.reset()
         self.reward_sum = 0.0
         self.step_sum = 0
@@ -438,8 +480,7 @@ class AgentInterAC(AgentBasicAC):
         update_freq = 2 ** 7  # delay update frequency, for soft target update
         self.act.eval()
 
-        loss_a_sum = 0.0
-        loss_c_sum = 0.0
+        self.metrics.reset()
 
         k = 1.0 + buffer.now_len / buffer.max_len
         batch_size_ = int(batch_size * k)
@@ -449,26 +490,14 @@ class AgentInterAC(AgentBasicAC):
             with torch.no_grad():
                 reward, mask, state, action, next_state = buffer.random_sample(batch_size_, self.device)
 
-                next_q_target, next_action = self.act_target.next__q_a(
-                    state, next_state, policy_noise)
-                q_target = reward + mask * next_q_target
-
-            '''critic loss'''
-            q_eval = self.act.critic(state, action)
-            critic_loss = self.criterion(q_eval, q_target)
-            loss_c_tmp = critic_loss.item()
-            loss_c_sum += loss_c_tmp
-            self.loss_c_sum += loss_c_tmp  # extension
-
-            '''actor correction term'''
-            actor_term = self.criterion(self.act(next_state), next_action)
-
-            if i % repeat_times == 0:
-                '''actor loss'''
-                action_cur = self.act(state)  # policy gradient
-                actor_loss = -self.act_target.critic(state, action_cur).mean()  # policy gradient
-                loss_a_sum += actor_loss.item()
+            is_actor_step = i % repeat_times == 0
+            critic_loss, actor_term, actor_loss = self.get_united_loss(
+                reward, mask, state, action, next_state, policy_noise, is_actor_step)
+            self.metrics.add('loss_c', critic_loss)
+            self.loss_c_sum += critic_loss.detach()  # extension
 
+            if is_actor_step:
+                self.metrics.add('loss_a', actor_loss)
                 united_loss = critic_loss + actor_term * (1 - self.rho) + actor_loss * (self.rho * 0.5)
             else:
                 united_loss = critic_loss + actor_term * (1 - self.rho)
@@ -482,16 +511,43 @@ class AgentInterAC(AgentBasicAC):
             if self.update_counter == update_freq:
                 self.update_counter = 0
 
-                rho = np.exp(-(self.loss_c_sum / update_freq) ** 2)
+                rho = np.exp(-(self.loss_c_sum.item() / update_freq) ** 2)
                 self.rho = (self.rho + rho) * 0.5
                 self.loss_c_sum = 0.0
 
                 if self.rho > 0.1:
                     self.act_target.load_state_dict(self.act.state_dict())
 
-        loss_a_avg = loss_a_sum / update_times
-        loss_c_avg = loss_c_sum / (update_times * repeat_times)
-        return loss_a_avg, loss_c_avg
+        return self.metrics.mean('loss_a'), self.metrics.mean('loss_c')
+
+    def get_united_loss(self, reward, mask, state, action, next_state, policy_noise, is_actor_step):
+        with torch.no_grad():
+            target_s_ = self.act_target.enc_s(state)  # reuse the state encoding of target network
+            target_next_s_ = self.act_target.enc_s(next_state)
+            next_q_target, next_action = self.act_target.next__q_a_(
+                target_s_, target_next_s_, policy_noise)
+            q_target = reward + mask * next_q_target
+
+        s_ = self.act.enc_s(state)  # reuse the state encoding in critic, actor and actor correction term
+        next_s_ = self.act.enc_s(next_state)
+
+        '''critic loss'''
+        q_eval = self.act.critic_(s_, action)
+        critic_loss = self.criterion(q_eval, q_target)
+
+        '''actor correction term'''
+        actor_term = self.criterion(self.act.actor_(next_s_), next_action)
+
+        '''actor loss'''
+        if is_actor_step:
+            action_cur = self.act.actor_(s_)  # policy gradient
+            actor_loss = -self.act_target.critic_(target_s_, action_cur).mean()  # policy gradient
+        else:
+            actor_loss = None
+        return critic_loss, actor_term, actor_loss
+
+    def init_compiled_step(self):  # the united loss (critic, actor correction term and actor) in one function
+        self.get_united_loss = CompiledFunction(self.get_united_loss)
 
     def save_or_load_model(self, mod_dir, is_save):
         act_save_path = '{}/actor.pth'.format(mod_dir)
@@ -540,18 +596,18 @@ class AgentTD3(AgentBasicAC):
         self.criterion = nn.MSELoss()
 
         '''training record'''
+        self.metrics = LossMetrics()  # accumulate loss on device, read by Recorder
+        self.fast_path = SingleStateInference(self.device)  # for select_action(), single state
         self.state = None  # env.reset()
         self.reward_sum = 0.0
         self.step_sum = 0
         self.update_counter = 0
 
     def update_parameters(self, buffer, max_step, batch_size, repeat_times):
-        policy_noise = 0.2  # standard deviation of policy noise
         update_freq = 2 * repeat_times  # delay update frequency, for soft target update
         self.act.train()
 
-        loss_a_sum = 0.0
-        loss_c_sum = 0.0
+        self.metrics.reset()
 
         k = 1.0 + buffer.now_len / buffer.max_len
         batch_size_ = int(batch_size * k)
@@ -561,14 +617,9 @@ class AgentTD3(AgentBasicAC):
             with torch.no_grad():
                 reward, mask, state, action, next_s = buffer.random_sample(batch_size_, self.device)
 
-                next_a = self.act_target(next_s, policy_noise)
-                next_q_target = torch.min(*self.cri_target.get__q1_q2(next_s, next_a))  # TD3
-                q_target = reward + mask * next_q_target
-
             '''critic_loss'''
-            q_eval1, q_eval2 = self.cri.get__q1_q2(state, action)  # TD3
-            critic_loss = self.criterion(q_eval1, q_target) + self.criterion(q_eval2, q_target)
-            loss_c_sum += critic_loss.item() * 0.5  # TD3
+            critic_loss = self.get_critic_loss(reward, mask, state, action, next_s)
+            self.metrics.add('loss_c', critic_loss * 0.5)  # TD3
 
             self.cri_optimizer.zero_grad()
             critic_loss.backward()
@@ -576,9 +627,10 @@ class AgentTD3(AgentBasicAC):
 
             '''actor_loss'''
             if i % repeat_times == 0:
-                action_pg = self.act(state)  # policy gradient
-                actor_loss = -self.cri(state, action_pg).mean()  # policy gradient
-                loss_a_sum += actor_loss.item()
+                self.set_requires_grad(self.cri, False)  # skip the gradient of critic parameters
+                actor_loss = self.get_actor_loss(state)
+                self.set_requires_grad(self.cri, True)
+                self.metrics.add('loss_a', actor_loss)
 
                 self.act_optimizer.zero_grad()
                 actor_loss.backward()
@@ -591,28 +643,160 @@ class AgentTD3(AgentBasicAC):
                 self.soft_target_update(self.act_target, self.act)  # soft target update
                 self.soft_target_update(self.cri_target, self.cri)  # soft target update
 
-        loss_a_avg = loss_a_sum / update_times
-        loss_c_avg = loss_c_sum / (update_times * repeat_times)
-        return loss_a_avg, loss_c_avg
+        return self.metrics.mean('loss_a'), self.metrics.mean('loss_c')
 
+    def get_critic_loss(self, reward, mask, state, action, next_s):
+        policy_noise = 0.2  # standard deviation of policy noise
 
-class AgentPPO:
-    def __init__(self, state_dim, action_dim, net_dim):
+        with torch.no_grad():
+            next_a = self.act_target(next_s, policy_noise)
+            next_q_target = torch.min(*self.cri_target.get__q1_q2(next_s, next_a))  # TD3
+            q_target = reward + mask * next_q_target
+
+        with autocast_bf16(self.use_bf16):
+            q_eval1, q_eval2 = self.cri.get__q1_q2(state, action)  # TD3
+        critic_loss = self.criterion(q_eval1.float(), q_target) + self.criterion(q_eval2.float(), q_target)
+        return critic_loss
+
+
+class AgentTD3Stack(AgentTD3):  # K AgentTD3 with stacked parameters, train K random seeds in one process
+    def __init__(self, state_dim, action_dim, net_dim, stack_num=4):
+        super(AgentBasicAC, self).__init__()
         self.learning_rate = 4e-4
+        self.stack_num = stack_num
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
         '''network'''
-        self.act = ActorPPO(state_dim, action_dim, net_dim).to(self.device)
+        actor_dim = net_dim
+        self.act = ActorDPGStack(stack_num, state_dim, action_dim, actor_dim).to(self.device)
         self.act.train()
-        self.act_optimizer = torch.optim.Adam(self.act.parameters(), lr=self.learning_rate * 0.5)  # betas=(0.5, 0.99))
+        self.act_optimizer = torch.optim.Adam(self.act.parameters(), lr=self.learning_rate * 0.5)
 
-        self.cri = CriticAdvantage(state_dim, net_dim).to(self.device)
+        self.act_target = ActorDPGStack(stack_num, state_dim, action_dim, actor_dim).to(self.device)
+        self.act_target.eval()
+        self.act_target.load_state_dict(self.act.state_dict())
+
+        critic_dim = int(net_dim * 1.25)
+        self.cri = CriticTwinStack(stack_num, state_dim, action_dim, critic_dim).to(self.device)
         self.cri.train()
         self.cri_optimizer = torch.optim.Adam(self.cri.parameters(), lr=self.learning_rate)
 
+        self.cri_target = CriticTwinStack(stack_num, state_dim, action_dim, critic_dim).to(self.device)
+        self.cri_target.eval()
+        self.cri_target.load_state_dict(self.cri.state_dict())
+
+        # the loss is the average of K agents. Adam is elementwise and is invariant to the 1/K gradient scale,
+        # so each slice of parameters is updated as an independent AgentTD3. update_parameters() of AgentTD3
+        # works on the tensor with shape (stack_num, batch_size, dim) without any modification.
+        self.criterion = nn.MSELoss()
+
+        '''training record'''
+        self.metrics = LossMetrics()  # accumulate loss on device, read by Recorder
+        self.state = None  # np.stack([env.reset() for env in env_list])
+        self.reward_sum = np.zeros(stack_num)
+        self.step_sum = np.zeros(stack_num, dtype=int)
+        self.update_counter = 0
+
+    def update_buffer(self, env_list, buffer, max_step, max_action, reward_scale, gamma):
+        explore_rate = 0.5  # explore rate when update_buffer()
+        explore_noise = 0.2  # standard deviation of explore noise
+        self.act.eval()
+
+        rewards = [list() for _ in range(self.stack_num)]
+        steps = [list() for _ in range(self.stack_num)]
+        for t in range(max_step):
+            '''inactive with environment'''
+            explore_noises = explore_noise * (rd.rand(self.stack_num) < explore_rate)
+            actions = self.select_actions(self.state, explore_noises)
+
+            memo_list = list()
+            for k, env in enumerate(env_list):
+                next_state, reward, done, _ = env.step(actions[k] * max_action)
+
+                self.reward_sum[k] += reward
+                self.step_sum[k] += 1
+
+                reward_ = reward * reward_scale
+                mask = 0.0 if done else gamma
+                memo_list.append(np.hstack((reward_, mask, self.state[k], actions[k], next_state)))
+
+                if done:
+                    rewards[k].append(self.reward_sum[k])
+                    self.reward_sum[k] = 0.0
+
+                    steps[k].append(self.step_sum[k])
+                    self.step_sum[k] = 0
+
+                    next_state = env.reset()
+                self.state[k] = next_state
+
+            '''update replay buffer'''
+            buffer.add_memo(np.stack(memo_list))
+        return rewards, steps
+
+    def select_actions(self, states, explore_noise=0.0, k=None):
+        states = torch.tensor(np.array(states), dtype=torch.float32, device=self.device)
+        if k is None:  # states.shape == (stack_num, state_dim), one state for each agent
+            actions = self.act(states.unsqueeze(1)).squeeze(1)
+            noise_std = torch.tensor(explore_noise, dtype=torch.float32, device=self.device).view(-1, 1)
+            actions = self.act.add_noise(actions, noise_std)
+        else:  # the k-th agent, states.shape == (batch_size, state_dim)
+            actions = self.act(states, explore_noise, k=k)
+        return actions.cpu().data.numpy()
+
+    def save_or_load_model(self, mod_dir, is_save, k=None):
+        act_save_path = '{}/actor.pth'.format(mod_dir)
+        cri_save_path = '{}/critic.pth'.format(mod_dir)
+
+        if k is None:  # the stacked parameters of all agents
+            super(AgentTD3Stack, self).save_or_load_model(mod_dir, is_save)
+        elif is_save:  # the k-th agent, save as the state_dict of (ActorDPG, CriticTwin) in AgentTD3
+            torch.save(self.act.get_state_dict_k(k), act_save_path)
+            torch.save(self.cri.get_state_dict_k(k), cri_save_path)
+        elif os.path.exists(act_save_path):
+            act_dict = torch.load(act_save_path, map_location=lambda storage, loc: storage)
+            self.act.load_state_dict_k(k, act_dict)
+            self.act_target.load_state_dict_k(k, act_dict)
+            cri_dict = torch.load(cri_save_path, map_location=lambda storage, loc: storage)
+            self.cri.load_state_dict_k(k, cri_dict)
+            self.cri_target.load_state_dict_k(k, cri_dict)
+        else:
+            print("FileNotFound when load_model: {}".format(mod_dir))
+
+
+class AgentPPO:
+    def __init__(self, state_dim, action_dim, net_dim, use_shared_trunk=False):
+        self.learning_rate = 4e-4
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+        '''network'''
+        self.use_shared_trunk = use_shared_trunk  # one forward for action mean and value, one optimizer step
+        if use_shared_trunk:
+            self.act = ActorCriticPPO(state_dim, action_dim, net_dim).to(self.device)
+            self.act.train()
+            self.act_optimizer = torch.optim.Adam(self.act.parameters(), lr=self.learning_rate * 0.5)
+
+            self.cri = None  # the value head is self.act.net_value on the shared trunk, see get_values()
+            self.cri_optimizer = None
+        else:
+            self.act = ActorPPO(state_dim, action_dim, net_dim).to(self.device)
+            self.act.train()
+            self.act_optimizer = torch.optim.Adam(self.act.parameters(), lr=self.learning_rate * 0.5)
+
+            self.cri = CriticAdvantage(state_dim, net_dim).to(self.device)
+            self.cri.train()
+            self.cri_optimizer = torch.optim.Adam(self.cri.parameters(), lr=self.learning_rate)
+
         self.criterion = nn.SmoothL1Loss()
+        self.target_kl = 0.02  # stop actor steps if approx_kl of an epoch > target_kl * 1.5, None: no early stop
+        self.lambda_adv = 0.97  # GAE, computed by buffer.finish_episode() during collection
+
+        '''training record'''
+        self.metrics = LossMetrics()  # accumulate loss on device, read by Recorder
+        self.fast_path = SingleStateInference(self.device)  # for select_action(), single state
+        self.skip_num = 0  # the number of actor steps skipped by early stop, read by Recorder
 
-    def update_buffer_ppo(self, env, buffer, max_step, max_memo, max_action, gamma, state_norm):
+    def update_buffer_ppo(self, env, buffer, max_step, max_memo, max_action, reward_scale, gamma, state_norm):
         rewards = []
         steps = []
 
@@ -624,9 +808,8 @@ class AgentPPO:
 
             state = state_norm(state)  # if state_norm:
             for step_sum in range(max_step):
-                action, log_prob = self.select_actions((state,), explore_noise=True)
-                action = action[0]
-                log_prob = log_prob[0]
+                action, log_prob = self.select_action(state, explore_noise=True)
+                action = action.copy()  # the action array of select_action() is reused in next call
 
                 next_state, reward, done, _ = env.step(action * max_action)
                 reward_sum += reward
@@ -634,11 +817,12 @@ class AgentPPO:
                 next_state = state_norm(next_state)  # if state_norm:
                 mask = 0 if done else gamma
 
-                buffer.push(reward, mask, state, action, log_prob, )
+                buffer.push(reward * reward_scale, mask, state, action, log_prob, )
 
                 if done:
                     break
                 state = next_state
+            buffer.finish_episode(self.get_values, self.lambda_adv)
 
             rewards.append(reward_sum)
 
@@ -647,97 +831,140 @@ class AgentPPO:
             step_counter += step_sum
         return rewards, steps
 
-    def update_parameters_ppo(self, buffer, batch_size):  # todo cancel all_value
+    def update_buffer_ppo_vec(self, env_list, buffer, max_step, max_memo, max_action, reward_scale, gamma,
+                              state_norm):
+        """
+        Vectorized rollout: one batched select_actions() (action and log_prob) per step over the envs.
+        The trajectory of each env is kept separate and pushed into buffer after its episode ends,
+        so that the episodes are contiguous for GAE. After max_memo, the envs finish their episodes and stop.
+        """
+        rewards = []
+        steps = []
+
+        env_num = len(env_list)
+        states = state_norm(np.array([env.reset() for env in env_list]))  # if state_norm: (batch update)
+        trajectories = [list() for _ in range(env_num)]
+        reward_sums = [0.0, ] * env_num
+        env_ids = list(range(env_num))  # the envs that are collecting
+
+        step_counter = 0
+        while env_ids:
+            actions, log_probs = self.select_actions(states[env_ids], explore_noise=True)
+
+            next_env_ids = list()
+            next_states = list()  # normalize the next states of all envs in one batch
+            for env_id, action, log_prob in zip(env_ids.copy(), actions, log_probs):
+                next_state, reward, done, _ = env_list[env_id].step(action * max_action)
+                reward_sums[env_id] += reward
+
+                mask = 0 if done else gamma
+                trajectory = trajectories[env_id]
+                trajectory.append((reward * reward_scale, mask, states[env_id].copy(), action, log_prob))
+                step_counter += 1
+
+                if done or len(trajectory) >= max_step:
+                    for memo in trajectory:
+                        buffer.push(*memo)
+                    buffer.finish_episode(self.get_values, self.lambda_adv)
+                    rewards.append(reward_sums[env_id])
+                    steps.append(len(trajectory))
+                    trajectory.clear()
+                    reward_sums[env_id] = 0.0
+
+                    if step_counter >= max_memo:
+                        env_ids.remove(env_id)
+                        continue
+                    next_state = env_list[env_id].reset()
+                next_env_ids.append(env_id)
+                next_states.append(next_state)
+
+            if next_env_ids:
+                states[next_env_ids] = state_norm(np.array(next_states))  # if state_norm:
+        return rewards, steps
+
+    def get_values(self, states):  # for buffer.finish_episode(), one batched critic forward for an episode
+        states = states.to(self.device)
+        values = self.act.critic(states) if self.use_shared_trunk else self.cri(states)
+        return values.flatten().cpu()
+
+    def update_parameters_ppo(self, buffer, batch_size, repeat_times=8):
         clip = 0.25  # 0.5
-        lambda_adv = 0.97
         lambda_entropy = 0.01
-        repeat_times = 8
         self.act.train()
 
-        loss_a_sum = 0.0
-        loss_c_sum = 0.0
+        self.metrics.reset()
 
-        all_batch = buffer.sample()
         max_memo = len(buffer)
-
-        with torch.no_grad():
-            all_reward = torch.tensor(all_batch.reward, dtype=torch.float32, device=self.device)
-            all_mask = torch.tensor(all_batch.mask, dtype=torch.float32, device=self.device)
-            all_state = torch.tensor(all_batch.state, dtype=torch.float32, device=self.device)
-            all_value = self.cri(all_state)
-            all_action = torch.tensor(all_batch.action, dtype=torch.float32, device=self.device)
-            all_log_prob = torch.tensor(all_batch.log_prob, dtype=torch.float32, device=self.device)
-
-        '''compute prev (value, return, advantage)'''
-        # Generalization Advantage Estimate. ICLR. 2016. https://arxiv.org/pdf/1506.02438.pdf
-        all_deltas = torch.empty(max_memo, dtype=torch.float32, device=self.device)
-        all_returns = torch.empty(max_memo, dtype=torch.float32, device=self.device)
-        all_advantages = torch.empty(max_memo, dtype=torch.float32, device=self.device)
-
-        prev_return = 0
-        prev_value = 0
-        prev_advantage = 0
-        for i in range(max_memo - 1, -1, -1):
-            all_deltas[i] = all_reward[i] + prev_value * all_mask[i] - all_value[i]
-            all_returns[i] = all_reward[i] + prev_return * all_mask[i]
-            # ref: https://arxiv.org/pdf/1506.02438.pdf (generalization advantage estimate)
-            all_advantages[i] = all_deltas[i] + lambda_adv * prev_advantage * all_mask[i]
-
-            prev_return = all_returns[i]
-            prev_value = all_value[i]
-            prev_advantage = all_advantages[i]
+        all_state, all_action, all_log_prob, all_returns, all_advantages = buffer.sample_all(self.device)
 
         all_advantages = (all_advantages - all_advantages.mean()) / (all_advantages.std() + 1e-6)  # if advantage_norm:
 
         '''mini batch sample'''
+        batch_num = max(1, max_memo // batch_size)  # the minibatches of an epoch, see get_minibatches()
+        is_actor_stop = False  # early stop only stops the actor steps, the critic finishes all epochs
+        kl_sum = 0.0  # the approx_kl of this epoch, on device
 
-        sample_times = int(repeat_times * max_memo / batch_size)
-        for i_epoch in range(sample_times):
-            '''random sample'''
-            indices = rd.choice(max_memo, batch_size, replace=False)
-
-            state = all_state[indices]
-            action = all_action[indices]
-            return_ = all_returns[indices]
-            advantage = all_advantages[indices]
-            old_log_prob = all_log_prob[indices]
-
+        all_tensors = (all_state, all_action, all_returns, all_advantages, all_log_prob)
+        minibatches = get_minibatches(all_tensors, batch_size, repeat_times)
+        for i, (state, action, return_, advantage, old_log_prob) in enumerate(minibatches):
             """Adaptive KL Penalty Coefficient
             loss_KLPEN = surrogate_obj + value_obj * loss_coeff_value + entropy_obj * lambda_entropy
             loss_KLPEN = (value_obj * loss_coeff_value)  (surrogate_obj + entropy_obj * lambda_entropy)
             loss_KLPEN = critic_loss + actor_loss
             """
 
+            if self.use_shared_trunk:
+                a_mean, new_values = self.act.get__a_mean__value(state)
+            else:
+                a_mean = None if is_actor_stop else self.act(state)
+                new_values = self.cri(state).flatten()
+
             '''critic_loss'''
-            new_values = self.cri(state).flatten()
             critic_loss = torch.mean((new_values - return_).pow(2)) / (return_.std() * 6)
-            loss_c_sum += critic_loss.item()
+            self.metrics.add('loss_c', critic_loss)
 
-            self.cri_optimizer.zero_grad()
-            critic_loss.backward()
-            self.cri_optimizer.step()
+            if not is_actor_stop:
+                # surrogate objective of TRPO
+                new_log_prob = self.act.get__log_prob(a_mean, action)
 
-            '''actor_loss'''
-            # surrogate objective of TRPO
-            new_log_prob = self.act.get__log_prob(state, action)
-            ratio = torch.exp(new_log_prob - old_log_prob)
-            surrogate_obj0 = advantage * ratio
-            surrogate_obj1 = advantage * ratio.clamp(1 - clip, 1 + clip)
-            surrogate_obj = - torch.mean(torch.min(surrogate_obj0, surrogate_obj1))
+                if self.target_kl is not None:  # approximate KL divergence, http://joschu.net/blog/kl-approx.html
+                    approx_kl = (old_log_prob - new_log_prob).mean().detach()
+                    self.metrics.add('kl', approx_kl)
+                    kl_sum = kl_sum + approx_kl
 
-            # policy entropy
-            entropy_obj = torch.mean(torch.exp(new_log_prob) * new_log_prob)
+                '''actor_loss'''
+                ratio = torch.exp(new_log_prob - old_log_prob)
+                surrogate_obj0 = advantage * ratio
+                surrogate_obj1 = advantage * ratio.clamp(1 - clip, 1 + clip)
+                surrogate_obj = - torch.mean(torch.min(surrogate_obj0, surrogate_obj1))
 
-            actor_loss = surrogate_obj + entropy_obj * lambda_entropy
-            loss_a_sum += actor_loss.item()
+                # policy entropy
+                entropy_obj = torch.mean(torch.exp(new_log_prob) * new_log_prob)
 
-            self.act_optimizer.zero_grad()
-            actor_loss.backward()
-            self.act_optimizer.step()
+                actor_loss = surrogate_obj + entropy_obj * lambda_entropy
+                self.metrics.add('loss_a', actor_loss)
+
+            if self.use_shared_trunk:  # loss_KLPEN = critic_loss + actor_loss, one backward through the trunk
+                self.act_optimizer.zero_grad()
+                (critic_loss if is_actor_stop else critic_loss + actor_loss).backward()
+                self.act_optimizer.step()
+            else:
+                self.cri_optimizer.zero_grad()
+                critic_loss.backward()
+                self.cri_optimizer.step()
+
+                if not is_actor_stop:
+                    self.act_optimizer.zero_grad()
+                    actor_loss.backward()
+                    self.act_optimizer.step()
 
-        loss_a_avg = loss_a_sum / sample_times
-        loss_c_avg = loss_c_sum / sample_times
-        return loss_a_avg, loss_c_avg
+            '''early stop'''
+            if self.target_kl is not None and not is_actor_stop and i % batch_num == batch_num - 1:
+                is_actor_stop = (kl_sum / batch_num).item() > self.target_kl * 1.5  # sync once per epoch
+                kl_sum = 0.0
+
+        self.skip_num = self.metrics.count('loss_c') - self.metrics.count('loss_a')
+        return self.metrics.mean('loss_a'), self.metrics.mean('loss_c')
 
     def select_actions(self, states, explore_noise=0.0):  # CPU array to GPU tensor to CPU array
         states = torch.tensor(states, dtype=torch.float32, device=self.device)
@@ -753,6 +980,17 @@ class AgentPPO:
             log_prob = log_prob.cpu().data.numpy()
             return a_noise, log_prob,
 
+    def select_action(self, state, explore_noise=0.0):  # NOTICE! the action array is reused in next call
+        with inference_mode():
+            state = self.fast_path.set_state(state)
+            action = self.act(state)
+
+            if explore_noise == 0.0:
+                return self.fast_path.get_output('action', action)
+            else:
+                a_noise, log_prob = self.act.get__a__log_prob(action)
+                return self.fast_path.get_output('action', a_noise), float(log_prob)
+
     def save_or_load_model(self, mod_dir, is_save):
         act_save_path = '{}/actor.pth'.format(mod_dir)
         # cri_save_path = '{}/critic.pth'.format(mod_dir)
@@ -801,6 +1039,8 @@ class AgentSAC(AgentBasicAC):  # todo
         self.criterion = nn.MSELoss()
 
         '''training record'''
+        self.metrics = LossMetrics()  # accumulate loss on device, read by Recorder
+        self.fast_path = SingleStateInference(self.device)  # for select_action(), single state
         self.state = None  # env.reset()
         self.reward_sum = 0.0
         self.step_sum = 0
@@ -813,12 +1053,10 @@ class AgentSAC(AgentBasicAC):  # todo
         self.target_entropy = -1
 
     def update_parameters(self, buffer, max_step, batch_size, repeat_times):
-        # policy_noise == (1.0 or True)  # stochastic policy choose noise_std by itself
         update_freq = 2 * repeat_times  # delay update frequency, for soft target update
         self.act.train()
 
-        loss_a_sum = 0.0
-        loss_c_sum = 0.0
+        self.metrics.reset()
 
         k = 1.0 + buffer.now_len / buffer.max_len
         batch_size_ = int(batch_size * k)
@@ -828,14 +1066,9 @@ class AgentSAC(AgentBasicAC):  # todo
             with torch.no_grad():
                 reward, mask, state, action, next_s = buffer.random_sample(batch_size_, self.device)
 
-                next_a_noise, next_log_prob = self.act_target.get__a__log_prob(next_s)
-                next_q_target = torch.min(*self.cri_target.get__q1_q2(next_s, next_a_noise))  # CriticTwin
-                next_q_target = next_q_target - next_log_prob * self.alpha  # SAC, alpha
-                q_target = reward + mask * next_q_target
             '''critic_loss'''
-            q1_value, q2_value = self.cri.get__q1_q2(state, action)  # CriticTwin
-            critic_loss = self.criterion(q1_value, q_target) + self.criterion(q2_value, q_target)
-            loss_c_sum += critic_loss.item() * 0.5  # CriticTwin
+            critic_loss = self.get_critic_loss(reward, mask, state, action, next_s)
+            self.metrics.add('loss_c', critic_loss * 0.5)  # CriticTwin
 
             self.cri_optimizer.zero_grad()
             critic_loss.backward()
@@ -843,8 +1076,10 @@ class AgentSAC(AgentBasicAC):  # todo
 
             '''actor_loss'''
             if i % repeat_times == 0:
-                # stochastic policy
-                actions_noise, log_prob = self.act.get__a__log_prob(state, self.device)  # policy gradient
+                self.set_requires_grad(self.cri, False)  # skip the gradient of critic parameters
+                log_prob, q_eval_pg = self.get_actor_loss(state)
+                self.set_requires_grad(self.cri, True)
+
                 # auto alpha
                 alpha_loss = -(self.log_alpha * (self.target_entropy + log_prob).detach()).mean()
                 self.alpha_optimizer.zero_grad()
@@ -853,9 +1088,8 @@ class AgentSAC(AgentBasicAC):  # todo
 
                 # policy gradient
                 self.alpha = self.log_alpha.exp()
-                q_eval_pg = self.cri(state, actions_noise)  # policy gradient # todo
                 actor_loss = (log_prob * self.alpha - q_eval_pg).mean()  # policy gradient
-                loss_a_sum += actor_loss.item()
+                self.metrics.add('loss_a', actor_loss)
 
                 self.act_optimizer.zero_grad()
                 actor_loss.backward()
@@ -868,9 +1102,26 @@ class AgentSAC(AgentBasicAC):  # todo
                 self.soft_target_update(self.act_target, self.act)  # soft target update
                 self.soft_target_update(self.cri_target, self.cri)  # soft target update
 
-        loss_a_avg = loss_a_sum / update_times
-        loss_c_avg = loss_c_sum / (update_times * repeat_times)
-        return loss_a_avg, loss_c_avg
+        return self.metrics.mean('loss_a'), self.metrics.mean('loss_c')
+
+    def get_critic_loss(self, reward, mask, state, action, next_s):
+        # policy_noise == (1.0 or True)  # stochastic policy choose noise_std by itself
+        with torch.no_grad():
+            next_a_noise, next_log_prob = self.act_target.get__a__log_prob(next_s)
+            next_q_target = torch.min(*self.cri_target.get__q1_q2(next_s, next_a_noise))  # CriticTwin
+            next_q_target = next_q_target - next_log_prob * self.alpha  # SAC, alpha
+            q_target = reward + mask * next_q_target
+
+        with autocast_bf16(self.use_bf16):
+            q1_value, q2_value = self.cri.get__q1_q2(state, action)  # CriticTwin
+        critic_loss = self.criterion(q1_value.float(), q_target) + self.criterion(q2_value.float(), q_target)
+        return critic_loss
+
+    def get_actor_loss(self, state):  # SAC updates alpha between log_prob and actor_loss, so it returns both parts
+        actions_noise, log_prob = self.act.get__a__log_prob(state)  # stochastic policy
+        with autocast_bf16(self.use_bf16):  # actor stays in float32 for log_prob, only critic
+            q_eval_pg = self.cri(state, actions_noise)  # policy gradient
+        return log_prob, q_eval_pg.float()
 
 
 class AgentDQN(AgentBasicAC):  # 2020-06-06 # todo
@@ -891,7 +1142,7 @@ class AgentDQN(AgentBasicAC):  # 2020-06-06 # todo
         act = QNetwork(state_dim, action_dim, actor_dim).to(self.device)
         act.train()
         self.act = act
-        self.act_optimizer = torch.optim.Adam(act.parameters(), lr=learning_rate)
+        self.act_optimizer = torch.optim.Adam(act.parameters(), lr=self.learning_rate)
 
         act_target = QNetwork(state_dim, action_dim, actor_dim).to(self.device)
         act_target.eval()
@@ -901,6 +1152,8 @@ class AgentDQN(AgentBasicAC):  # 2020-06-06 # todo
         self.criterion = nn.MSELoss()
 
         '''training record'''
+        self.metrics = LossMetrics()  # accumulate loss on device, read by Recorder
+        self.fast_path = SingleStateInference(self.device)  # for select_action(), single state
         self.state = env.reset()
         self.reward_sum = 0.0
         self.step_sum = 0
@@ -911,8 +1164,7 @@ class AgentDQN(AgentBasicAC):  # 2020-06-06 # todo
         self.policy_noise = 0.2
 
     def update_parameters(self, buffer, max_step, batch_size_, update_gap):
-        loss_a_sum = 0.0
-        loss_c_sum = 0.0
+        self.metrics.reset()
 
         k = 1.0 + buffer.now_len / buffer.max_len
         batch_size_ = int(batch_size_ * k)
@@ -922,14 +1174,9 @@ class AgentDQN(AgentBasicAC):  # 2020-06-06 # todo
             with torch.no_grad():
                 rewards, masks, states, actions, next_states = buffer.random_sample(batch_size_, self.device)
 
-                q_target = self.act_target(next_states).max(dim=1, keepdim=True)[0]
-                q_target = rewards + masks * q_target
-
             self.act.train()
-            actions = actions.type(torch.long)
-            q_eval = self.act(states).gather(1, actions)
-            critic_loss = self.criterion(q_eval, q_target)
-            loss_c_sum += critic_loss.item()
+            critic_loss = self.get_critic_loss(rewards, masks, states, actions, next_states)
+            self.metrics.add('loss_c', critic_loss)
 
             self.act_optimizer.zero_grad()
             critic_loss.backward()
@@ -940,13 +1187,31 @@ class AgentDQN(AgentBasicAC):  # 2020-06-06 # todo
                 self.update_counter = 0
                 self.act_target.load_state_dict(self.act.state_dict())
 
-        return loss_a_sum / iter_step, loss_c_sum / iter_step,
+        return self.metrics.mean('loss_a'), self.metrics.mean('loss_c')
+
+    def get_critic_loss(self, rewards, masks, states, actions, next_states):
+        with torch.no_grad():
+            q_target = self.act_target(next_states).max(dim=1, keepdim=True)[0]
+            q_target = rewards + masks * q_target
+
+        q_eval = self.act(states).gather(1, actions.type(torch.long))
+        critic_loss = self.criterion(q_eval, q_target)
+        return critic_loss
+
+    def init_compiled_step(self):  # DQN has no actor loss
+        self.get_critic_loss = CompiledFunction(self.get_critic_loss)
 
     def select_actions(self, states, explore_noise=0.0):  # state -> ndarray shape: (1, state_dim)
         states = torch.tensor(states, dtype=torch.float32, device=self.device)
         actions = self.act(states, explore_noise).argmax(dim=1).cpu().data.numpy()
         return actions
 
+    def select_action(self, state, explore_noise=0.0):  # Discrete action space, return an int
+        with inference_mode():
+            state = self.fast_path.set_state(state)
+            q_value = self.act(state, explore_noise)
+            return int(q_value.argmax(dim=1))
+
     def save_or_load_model(self, mod_dir, is_save):
         act_save_path = '{}/actor.pth'.format(mod_dir)
 
@@ -1007,9 +1272,90 @@ def initial_exploration(env, memo, max_step, action_max, reward_scale, gamma, ac
     return rewards, steps
 
 
+def initial_exploration_stack(env_list, buffer, max_step, action_max, reward_scale, gamma, action_dim):
+    stack_num = len(env_list)  # for AgentTD3Stack (continuous action space)
+    states = [env.reset() for env in env_list]
+
+    rewards = [list() for _ in range(stack_num)]
+    reward_sums = [0.0, ] * stack_num
+    steps = [list() for _ in range(stack_num)]
+    step_sums = [0, ] * stack_num
+
+    for _ in range(max_step):
+        memo_list = list()
+        for k, env in enumerate(env_list):
+            action = rd.uniform(-1, 1, size=action_dim)
+            next_state, reward, done, _ = env.step(action * action_max)
+            reward_sums[k] += reward
+            step_sums[k] += 1
+
+            adjust_reward = reward * reward_scale
+            mask = 0.0 if done else gamma
+            memo_list.append(np.hstack((adjust_reward, mask, states[k], action, next_state)))
+
+            if done:
+                rewards[k].append(reward_sums[k])
+                steps[k].append(step_sums[k])
+                reward_sums[k] = 0.0
+                step_sums[k] = 0
+
+                next_state = env.reset()  # reset the environment
+            states[k] = next_state
+        buffer.add_memo(np.stack(memo_list))
+
+    buffer.init_before_sample()
+    return rewards, steps
+
+
 """utils"""
 
 
+def autocast_bf16(enabled):  # mixed precision training on CPU (bfloat16)
+    """
+    Only the forward (and its backward) of act and cri run in bfloat16 under CPU autocast.
+    Parameters (optimizer master weights), target networks and the loss reduction stay float32.
+    """
+    if enabled and hasattr(torch, 'autocast'):  # torch >= 1.10
+        return torch.autocast(device_type='cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+class CompiledFunction:  # torch.compile (PyTorch 2.0) the loss function when available, else run in eager mode
+    def __init__(self, func):
+        self.func = func
+        self.compiled_func = torch.compile(func) if hasattr(torch, 'compile') else None
+        self.is_warm = False  # the backward of compiled function has run once
+
+    def __call__(self, *args):
+        if self.compiled_func is not None:
+            try:
+                if not self.is_warm:
+                    self.warm_up_backward(*args)
+                    self.is_warm = True
+                return self.compiled_func(*args)
+            except Exception as error:  # such as: no C++ compiler for the backend, unsupported operator
+                print("| CompiledFunction: fall back to eager mode. {}".format(repr(error)[:128]))
+                self.compiled_func = None
+        return self.func(*args)
+
+    def warm_up_backward(self, *args):
+        """
+        The backward of compiled function is compiled at the first loss.backward(), outside of __call__().
+        Run a forward and backward here once, so that its error falls back to eager mode too.
+        The compiled backward frees its saved tensors (donated buffers), so the warm up can't share the outputs
+        with update_parameters() by backward(retain_graph=True). It runs an extra forward instead, and restores
+        the random state, so that the random ops (explore noise) of the returned outputs are the same as eager mode.
+        The gradient of warm up is cleared by optimizer.zero_grad() before the backward() of update_parameters().
+        """
+        devices = [torch.cuda.current_device()] if torch.cuda.is_available() else []
+        with torch.random.fork_rng(devices=devices):
+            outputs = self.compiled_func(*args)
+        outputs = outputs if isinstance(outputs, tuple) else (outputs,)
+        outputs = [output.float().sum() for output in outputs if torch.is_tensor(output) and output.requires_grad]
+        if outputs:
+            sum(outputs).backward()
+
+
 class BufferListPPO:
     def __init__(self, ):
         self.storage = list()
@@ -1031,6 +1377,71 @@ class BufferListPPO:
         return len(self.storage)
 
 
+class BufferArrayPPO:  # rollout buffer of on-policy PPO, preallocated and reused in each epoch
+    def __init__(self, memo_max_len, state_dim, action_dim):
+        """
+        memo_max_len: max_memo + max_step, update_buffer_ppo() stops after the episode that exceeds max_memo
+        """
+        memo_dim = 1 + 1 + state_dim + action_dim + 1 + 2  # reward, mask, state, action, log_prob, return, advantage
+        self.memories = torch.empty((memo_max_len, memo_dim), dtype=torch.float32)
+        self.memo_array = self.memories.numpy()  # share memory with self.memories, for push() on CPU
+
+        self.next_idx = 0
+        self.episode_idx = 0  # the start of the episode that is collecting
+        self.max_len = memo_max_len
+        self.state_idx = 1 + 1 + state_dim  # reward_dim==1, done_dim==1
+        self.action_idx = self.state_idx + action_dim
+        self.return_idx = self.action_idx + 1  # log_prob_dim==1
+
+    def push(self, reward, mask, state, action, log_prob):
+        memo = self.memo_array[self.next_idx]
+        memo[0] = reward
+        memo[1] = mask
+        memo[2:self.state_idx] = state
+        memo[self.state_idx:self.action_idx] = action
+        memo[self.action_idx] = log_prob
+        self.next_idx += 1
+
+    def finish_episode(self, get_values, lambda_adv):  # compute the return and advantage (GAE) of the last episode
+        """
+        get_values: states -> values, one batched critic forward for the whole episode
+        It runs after each episode ends during collection, instead of a serial pass over the full buffer before
+        update. The last step of an episode has no next value, the same as prev_value = 0 of the full buffer pass.
+        """
+        memory = self.memories[self.episode_idx:self.next_idx]
+        self.episode_idx = self.next_idx
+        if len(memory) == 0:
+            return
+        reward = memory[:, 0]
+        mask = memory[:, 1]  # mark == (1-float(done)) * gamma
+
+        # Generalization Advantage Estimate. ICLR. 2016. https://arxiv.org/pdf/1506.02438.pdf
+        with torch.no_grad():
+            value = get_values(memory[:, 2:self.state_idx])
+        next_value = torch.cat((value[1:], value.new_zeros(1)))
+        delta = reward + next_value * mask - value
+        memory[:, self.return_idx] = get_reverse_scan(reward, mask)
+        memory[:, self.return_idx + 1] = get_reverse_scan(delta, lambda_adv * mask)
+
+    def sample_all(self, device):  # the views of memories, without copying on CPU
+        memory = self.memories[:self.next_idx].to(device)
+        tensors = (
+            memory[:, 2:self.state_idx],  # states
+            memory[:, self.state_idx:self.action_idx],  # actions
+            memory[:, self.action_idx],  # log_probs
+            memory[:, self.return_idx],  # returns
+            memory[:, self.return_idx + 1],  # advantages
+        )
+        return tensors
+
+    def empty_memories(self):  # reuse the memories in next epoch
+        self.next_idx = 0
+        self.episode_idx = 0
+
+    def __len__(self):
+        return self.next_idx
+
+
 class BufferList:
     def __init__(self, memo_max_len):
         self.memories = list()
@@ -1171,12 +1582,136 @@ class BufferArray:  # 2020-05-20
         return tensors
 
 
+class BufferArrayStack:  # K replay buffers for AgentTD3Stack, sample K batches in one gather
+    def __init__(self, stack_num, memo_max_len, state_dim, action_dim, ):
+        memo_dim = 1 + 1 + state_dim + action_dim + state_dim
+        self.memories = np.empty((stack_num, memo_max_len, memo_dim), dtype=np.float32)
+        self.stack_idx = np.arange(stack_num)[:, np.newaxis]
+        self.stack_num = stack_num
+
+        self.next_idx = 0
+        self.is_full = False
+        self.max_len = memo_max_len
+        self.now_len = self.max_len if self.is_full else self.next_idx
+
+        self.state_idx = 1 + 1 + state_dim  # reward_dim==1, done_dim==1
+        self.action_idx = self.state_idx + action_dim
+
+    def add_memo(self, memo_array):  # memo_array.shape == (stack_num, memo_dim), one memory for each agent
+        self.memories[:, self.next_idx] = memo_array
+        self.next_idx = self.next_idx + 1
+        if self.next_idx >= self.max_len:
+            self.is_full = True
+            self.next_idx = 0
+
+    def init_before_sample(self):
+        self.now_len = self.max_len if self.is_full else self.next_idx
+
+    def random_sample(self, batch_size, device):
+        indices = rd.randint(self.now_len, size=(self.stack_num, batch_size))
+        memory = self.memories[self.stack_idx, indices]  # memory.shape == (stack_num, batch_size, memo_dim)
+        if device:
+            memory = torch.tensor(memory, device=device)
+
+        '''convert array into torch.tensor'''
+        tensors = (
+            memory[:, :, 0:1],  # rewards
+            memory[:, :, 1:2],  # masks, mark == (1-float(done)) * gamma
+            memory[:, :, 2:self.state_idx],  # states
+            memory[:, :, self.state_idx:self.action_idx],  # actions
+            memory[:, :, self.action_idx:],  # next_states
+        )
+        return tensors
+
+
+class AgentStackView:  # the k-th agent of AgentTD3Stack, for Recorder and get_eva_reward()
+    def __init__(self, agent, k):
+        self.agent = agent
+        self.act = agent.act
+        self.k = k
+
+    def select_actions(self, states, explore_noise=0.0):
+        return self.agent.select_actions(states, explore_noise, k=self.k)
+
+    def save_or_load_model(self, mod_dir, is_save):
+        self.agent.save_or_load_model(mod_dir, is_save, k=self.k)
+
+
+class SingleStateInference:  # select_action() of one state, without allocating the input and output arrays
+    def __init__(self, device):
+        self.device = device
+        self.state_cpu = None  # torch.tensor, the preallocated input (batch_size == 1)
+        self.state_ary = None  # np.array, share memory with self.state_cpu
+        self.state_dev = None  # the same as self.state_cpu on CPU
+        self.output_dict = dict()  # {name: (output_cpu, output_ary)}, the reusable output
+
+    def set_state(self, state):  # copy the observation into the preallocated tensor
+        if self.state_ary is None:
+            self.state_cpu = torch.empty((1, len(state)), dtype=torch.float32)
+            self.state_ary = self.state_cpu.numpy()
+            self.state_dev = self.state_cpu if self.device.type == 'cpu' else self.state_cpu.to(self.device)
+        self.state_ary[0] = state
+        if self.state_dev is not self.state_cpu:
+            self.state_dev.copy_(self.state_cpu)
+        return self.state_dev
+
+    def get_output(self, name, tensor):  # copy the output into the reusable buffer, return its NumPy view
+        if name not in self.output_dict:
+            output_cpu = torch.empty(tensor.shape, dtype=tensor.dtype)
+            self.output_dict[name] = (output_cpu, output_cpu.numpy())
+        output_cpu, output_ary = self.output_dict[name]
+        output_cpu.copy_(tensor)
+        return output_ary[0]
+
+
+def inference_mode():  # torch.inference_mode() (PyTorch 1.9) skips the autograd bookkeeping more than no_grad()
+    return torch.inference_mode() if hasattr(torch, 'inference_mode') else torch.no_grad()
+
+
+class LossMetrics:  # accumulate the detached loss on device, avoid calling loss.item() in each update step
+    def __init__(self):
+        self.sum_dict = dict()  # {phase: loss_sum (tensor on device)}
+        self.max_dict = dict()  # {phase: loss_max (tensor on device)}
+        self.cnt_dict = dict()  # {phase: loss_cnt (int)}
+
+    def reset(self):
+        self.sum_dict = dict()
+        self.max_dict = dict()
+        self.cnt_dict = dict()
+
+    def add(self, phase, loss):
+        loss = loss.detach()
+        if phase in self.cnt_dict:
+            self.sum_dict[phase] += loss
+            self.max_dict[phase] = torch.max(self.max_dict[phase], loss)
+            self.cnt_dict[phase] += 1
+        else:
+            self.sum_dict[phase] = loss.clone()
+            self.max_dict[phase] = loss.clone()
+            self.cnt_dict[phase] = 1
+
+    def count(self, phase):
+        return self.cnt_dict.get(phase, 0)
+
+    def mean(self, phase):  # lazy: it is still a tensor on device until float(mean) or mean.item()
+        cnt = self.cnt_dict.get(phase, 0)
+        return self.sum_dict[phase] / cnt if cnt else 0.0
+
+    def max(self, phase):  # lazy
+        return self.max_dict[phase] if phase in self.max_dict else 0.0
+
+    def items(self):  # materialize all phases, synchronize with device here
+        return [(phase, float(self.mean(phase)), float(self.max(phase)), self.count(phase))
+                for phase in self.cnt_dict]
+
+
 class Recorder:
     def __init__(self, agent, max_step, max_action, target_reward,
                  env_name, eva_size=100, show_gap=2 ** 7, smooth_kernel=2 ** 4,
-                 state_norm=None, **_kwargs):
+                 state_norm=None, record_gif=False, **_kwargs):
         self.show_gap = show_gap
         self.smooth_kernel = smooth_kernel
+        self.gif_recorder = GifRecorder(env_name, max_step, max_action) if record_gif else None
 
         '''get_eva_reward(agent, env_list, max_step, max_action)'''
         self.agent = agent
@@ -1188,7 +1723,7 @@ class Recorder:
         self.running_stat = state_norm
 
         '''reward'''
-        self.rewards = get_eva_reward(agent, self.env_list[:5], max_step, max_action, self.running_stat)
+        self.rewards = get_eva_reward(agent, self.env_list[:5], max_step, max_action, self.get_running_stat())
         self.reward_avg = np.average(self.rewards)
         self.reward_std = float(np.std(self.rewards))
         self.reward_target = target_reward
@@ -1196,16 +1731,34 @@ class Recorder:
 
         self.record_epoch = list()  # record_epoch.append((epoch_reward, actor_loss, critic_loss, iter_num))
         self.record_eval = [(0, self.reward_avg, self.reward_std), ]  # [(epoch, reward_avg, reward_std), ]
+        self.record_skip = list()  # record_skip.append(skip_num), the actor steps skipped by early stop of PPO
+        self.record_loss = list()  # record_loss.append((max_a, max_c, cnt_a, cnt_c)), see agent.metrics
         self.total_step = 0
 
         self.epoch = 0
         self.train_time = 0  # train_time
         self.train_timer = timer()  # train_time
         self.start_time = self.show_time = timer()
-        print("epoch|   reward   r_max    r_ave    r_std |  loss_A loss_C |step")
+        print("epoch|   reward   r_max    r_ave    r_std |  loss_A loss_C |step     |   max_A  max_C |   n_A    n_C")
+
+    def get_running_stat(self):  # the snapshot of state_norm that training uses, fixed during one evaluation
+        return self.running_stat.get_snapshot() if self.running_stat else None
+
+    def get_row_str(self, smooth_reward, loss_a, loss_c):  # one row format for show_reward and check_reward
+        row_str = "{:4} |{:>8} {:8.2f} {:8.2f} {:8.2f} |{:8.2f} {:6.2f} |{:.2e}".format(
+            len(self.record_epoch),
+            smooth_reward, self.reward_max, self.reward_avg, self.reward_std,
+            loss_a, loss_c, self.total_step)
+        if self.record_loss:
+            max_a, max_c, cnt_a, cnt_c = self.record_loss[-1]
+            row_str += " |{:8.2f} {:6.2f} |{:6} {:6}".format(max_a, max_c, cnt_a, cnt_c)
+        if self.record_skip:  # AgentPPO with early stop (target_kl)
+            row_str += " |skip {}".format(sum(self.record_skip[-self.smooth_kernel:]))
+        return row_str
 
     def show_reward(self, epoch_rewards, iter_numbers, loss_a, loss_c):
         self.train_time += timer() - self.train_timer  # train_time
+        loss_a, loss_c = float(loss_a), float(loss_c)  # the loss from LossMetrics is a lazy tensor on device
         self.epoch += len(epoch_rewards)
 
         if isinstance(epoch_rewards, float):
@@ -1214,20 +1767,23 @@ class Recorder:
         for reward, iter_num in zip(epoch_rewards, iter_numbers):
             self.record_epoch.append((reward, loss_a, loss_c, iter_num))
             self.total_step += iter_num
+        if hasattr(self.agent, 'skip_num'):  # AgentPPO with early stop (target_kl)
+            self.record_skip.append(self.agent.skip_num)
+        if hasattr(self.agent, 'metrics'):  # the max and the number of updates of each loss in this epoch
+            metrics = self.agent.metrics
+            self.record_loss.append((float(metrics.max('loss_a')), float(metrics.max('loss_c')),
+                                     metrics.count('loss_a'), metrics.count('loss_c')))
 
         if timer() - self.show_time > self.show_gap:
             self.rewards = get_eva_reward(self.agent, self.env_list[:self.e1], self.max_step, self.max_action,
-                                          self.running_stat)
+                                          self.get_running_stat())
             self.reward_avg = np.average(self.rewards)
             self.reward_std = float(np.std(self.rewards))
             self.record_eval.append((len(self.record_epoch), self.reward_avg, self.reward_std))
 
             slice_reward = np.array(self.record_epoch[-self.smooth_kernel:])[:, 0]
-            smooth_reward = np.average(slice_reward, axis=0)
-            print("{:4} |{:8.2f} {:8.2f} {:8.2f} {:8.2f} |{:8.2f} {:6.2f} |{:.2e}".format(
-                len(self.record_epoch),
-                smooth_reward, self.reward_max, self.reward_avg, self.reward_std,
-                loss_a, loss_c, self.total_step))
+            smooth_reward = "{:8.2f}".format(np.average(slice_reward, axis=0))
+            print(self.get_row_str(smooth_reward, loss_a, loss_c))
 
             self.show_time = timer()  # reset show_time after get_eva_reward_batch !
         else:
@@ -1235,9 +1791,11 @@ class Recorder:
 
     def check_reward(self, cwd, loss_a, loss_c):  # 2020-05-05
         is_solved = False
+        loss_a, loss_c = float(loss_a), float(loss_c)  # the loss from LossMetrics is a lazy tensor on device
         if self.reward_avg >= self.reward_max:  # and len(self.rewards) > 1:  # 2020-04-30
+            running_stat = self.get_running_stat()
             self.rewards.extend(get_eva_reward(self.agent, self.env_list[:self.e2], self.max_step, self.max_action,
-                                               self.running_stat))
+                                               running_stat))
             self.reward_avg = np.average(self.rewards)
 
             if self.reward_avg >= self.reward_max:
@@ -1245,12 +1803,14 @@ class Recorder:
 
                 '''NOTICE! Recorder saves the agent with max reward automatically. '''
                 self.agent.save_or_load_model(cwd, is_save=True)
+                if self.gif_recorder:  # replay the snapshot of saved actor in a background process
+                    self.gif_recorder.record(self.agent.act, cwd, running_stat)
 
                 if self.reward_max >= self.reward_target:
                     res_env_len = len(self.env_list) - len(self.rewards)
                     self.rewards.extend(get_eva_reward(
                         self.agent, self.env_list[:res_env_len], self.max_step, self.max_action,
-                        self.running_stat))
+                        running_stat))
                     self.reward_avg = np.average(self.rewards)
                     self.reward_max = self.reward_avg
 
@@ -1260,10 +1820,7 @@ class Recorder:
 
             self.reward_std = float(np.std(self.rewards))
             self.record_eval[-1] = (len(self.record_epoch), self.reward_avg, self.reward_std)  # refresh
-            print("{:4} |{:8} {:8.2f} {:8.2f} {:8.2f} |{:8.2f} {:6.2f} |{:.2e}".format(
-                len(self.record_epoch),
-                '', self.reward_max, self.reward_avg, self.reward_std,
-                loss_a, loss_c, self.total_step, ))
+            print(self.get_row_str('', loss_a, loss_c))
 
         self.train_timer = timer()  # train_time
         return is_solved
@@ -1283,11 +1840,90 @@ class Recorder:
 
         np.save('%s/record_epoch.npy' % cwd, self.record_epoch)
         np.save('%s/record_eval.npy' % cwd, self.record_eval)
+        if self.record_skip:
+            np.save('%s/record_skip.npy' % cwd, self.record_skip)
+        if self.record_loss:
+            np.save('%s/record_loss.npy' % cwd, self.record_loss)
         print("Saved record_*.npy in:", cwd)
 
+        if self.gif_recorder:
+            self.gif_recorder.join()
+
         return self.train_time
 
 
+class GifRecorder:  # record the episode of actor into a GIF under cwd, without stalling the training
+    def __init__(self, env_name, max_step, max_action, max_bytes=2 ** 23, frame_skip=2, scale=2):
+        self.env_name = env_name
+        self.max_step = max_step
+        self.max_action = max_action
+        self.max_bytes = max_bytes  # the GIF stops growing after max_bytes of frames (1 byte per pixel)
+        self.frame_skip = frame_skip  # record one frame in every frame_skip steps
+        self.scale = scale  # downsample the rgb_array frame
+        self.process = None
+
+    def record(self, act, cwd, running_stat=None):
+        import copy
+        import multiprocessing as mp
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()  # the actor is outdated, record the new best actor
+            self.process.join()
+
+        act = copy.deepcopy(act).cpu().eval()  # snapshot
+        if hasattr(act, 'device'):
+            act.device = torch.device('cpu')
+        gif_path = '{}/{}.gif'.format(cwd, self.env_name)
+        args = (act, self.env_name, gif_path, self.max_step, self.max_action, copy.deepcopy(running_stat),
+                self.max_bytes, self.frame_skip, self.scale)
+        self.process = mp.get_context('spawn').Process(target=process__record_gif, args=args, daemon=True)
+        self.process.start()
+
+    def join(self):
+        if self.process is not None:
+            self.process.join()
+
+
+def process__record_gif(act, env_name, gif_path, max_step, max_action, running_stat,
+                        max_bytes, frame_skip, scale):
+    from PIL import Image, GifImagePlugin  # optional dependency, only for recording GIF
+    torch.set_num_threads(1)
+    env = gym.make(env_name)
+    is_discrete = act.__class__.__name__ == 'QNetwork'
+    fps = env.metadata.get('video.frames_per_second', 50)
+    duration = int(1000 * frame_skip / fps)  # Pillow: milliseconds per frame
+
+    tmp_path = '{}.tmp.gif'.format(gif_path[:-4])  # the GIF of last record is replaced after finishing
+    gif_file = open(tmp_path, 'wb')  # stream the frames into GIF, only one frame in memory
+    frame_bytes = 0
+    state = env.reset()
+    for i in range(max_step):
+        if i % frame_skip == 0:
+            frame = Image.fromarray(env.render(mode='rgb_array')[::scale, ::scale]).quantize()
+            if frame_bytes == 0:
+                gif_file.write(b''.join(GifImagePlugin.getheader(frame, info={'loop': 0})[0]))
+            gif_file.write(b''.join(GifImagePlugin.getdata(frame, duration=duration, include_color_table=True)))
+            frame_bytes += frame.width * frame.height  # palette frame, 1 byte per pixel
+            if frame_bytes > max_bytes:  # bound the size of GIF
+                print("| GifRecorder: the frames reach max_bytes {:.2e}, stop recording at step {}".format(
+                    max_bytes, i))
+                break
+
+        if running_stat:
+            state = running_stat(state, update=False)
+        with torch.no_grad():
+            output = act(torch.as_tensor((state,), dtype=torch.float32))[0]
+        action = int(output.argmax()) if is_discrete else output.numpy() * max_action
+
+        state, reward, done, _ = env.step(action)
+        if done:
+            break
+    env.close()
+
+    gif_file.write(b';')  # GIF trailer
+    gif_file.close()
+    os.replace(tmp_path, gif_path)
+
+
 class RewardNormalization:
     def __init__(self, n_max, n_min, size=2 ** 7):
         self.k = size / (n_max - n_min)
@@ -1298,24 +1934,70 @@ class RewardNormalization:
         return n * self.k
 
 
+def get_minibatches(tensors, batch_size, repeat_times):  # minibatch epochs of PPO
+    """
+    Permute the indices once per epoch and gather the whole rollout once, then each minibatch is a contiguous view.
+    Each sample is visited once per epoch, instead of rd.choice(max_memo, batch_size, replace=False) per minibatch.
+    """
+    max_memo = len(tensors[0])
+    batch_num = max(1, max_memo // batch_size)  # the final short chunk (< batch_size) joins the last minibatch
+    for _ in range(repeat_times):
+        indices = torch.randperm(max_memo, device=tensors[0].device)
+        epoch_tensors = [tensor[indices] for tensor in tensors]
+        for i in range(batch_num):
+            j = i * batch_size
+            k = max_memo if i == batch_num - 1 else j + batch_size
+            yield tuple(tensor[j:k] for tensor in epoch_tensors)
+
+
+def get_reverse_scan(values, discounts):  # for the return and advantage (GAE) of PPO
+    """
+    ys[i] = values[i] + discounts[i] * ys[i + 1], ys[n] = 0. It is the same as the reverse loop:
+    for i in range(n - 1, -1, -1): prev_y = ys[i] = values[i] + discounts[i] * prev_y
+    Recursive doubling: log2(n) steps of tensor ops instead of n steps of indexing device tensors.
+    """
+    ys = values.clone()
+    ds = discounts.clone()
+    n = len(ys)
+    d = 1
+    while d < n:  # ys[i] = sum(values[i:i+d*2] * discount), ds[i] = prod(discounts[i:i+d*2])
+        ys[:-d] = ys[:-d] + ds[:-d] * ys[d:]
+        ds[:-d] = ds[:-d] * ds[d:]
+        d *= 2
+    return ys
+
+
 class RunningStat:  # for class AutoNormalization
     def __init__(self, shape):
         self._n = 0
         self._M = np.zeros(shape)
         self._S = np.zeros(shape)
 
-    def push(self, x):
+    def push(self, x):  # one observation, x.shape == self.shape
         x = np.asarray(x)
-        # assert x.shape == self._M.shape
         self._n += 1
-        if self._n == 1:
-            self._M[...] = x
-        else:
-            pre_memo = self._M.copy()
-            self._M[...] = pre_memo + (x - pre_memo) / self._n
-            self._S[...] = self._S + (x - pre_memo) * (x - self._M)
-
-            self._n = min(self._n, 1e6)  # todo
+        delta = x - self._M
+        self._M += delta / self._n
+        self._S += delta * (x - self._M)
+        self._n = min(self._n, 1e6)  # todo
+
+    def push_batch(self, xs):  # a batch of observations, xs.shape == (batch_size, *self.shape)
+        xs = np.asarray(xs)
+        if len(xs):
+            mean = xs.mean(axis=0)
+            self.push_stat(len(xs), mean, np.square(xs - mean).sum(axis=0))
+
+    def merge(self, other):  # merge the statistics of another RunningStat, such as the one of another worker
+        if other.n:
+            self.push_stat(other.n, other.mean, other._S)
+
+    def push_stat(self, n, mean, sum_sq):  # parallel Welford (Chan et al.), sum_sq: sum of squared deviations
+        pre_n = self._n
+        self._n = pre_n + n
+        delta = mean - self._M
+        self._M += delta * (n / self._n)
+        self._S += sum_sq + np.square(delta) * (pre_n * n / self._n)
+        self._n = min(self._n, 1e6)  # todo
 
     @property
     def n(self):
@@ -1333,6 +2015,10 @@ class RunningStat:  # for class AutoNormalization
     def std(self):
         return np.sqrt(self.var)
 
+    @property
+    def sum_sq(self):
+        return self._S
+
     @property
     def shape(self):
         return self._M.shape
@@ -1346,9 +2032,12 @@ class AutoNormalization:
 
         self.rs = RunningStat(shape)
 
-    def __call__(self, x, update=True):
+    def __call__(self, x, update=True):  # x can be a batch of observations, x.shape == (batch_size, *shape)
         if update:
-            self.rs.push(x)
+            if np.ndim(x) > len(self.rs.shape):
+                self.rs.push_batch(x)
+            else:
+                self.rs.push(x)
         if self.demean:
             x = x - self.rs.mean
         if self.destd:
@@ -1357,6 +2046,80 @@ class AutoNormalization:
             x = np.clip(x, -self.clip, self.clip)
         return x
 
+    def get_snapshot(self):  # a frozen copy for evaluation, such as Recorder and GifRecorder
+        import copy
+        state_norm = AutoNormalization(self.rs.shape, self.demean, self.destd, self.clip)
+        state_norm.rs = copy.deepcopy(self.rs)
+        return state_norm
+
+
+class SharedNormalization(AutoNormalization):  # AutoNormalization shared by the collectors in several processes
+    def __init__(self, shape, demean=True, destd=True, clip=6.0, sync_gap=2 ** 10):
+        """
+        The running statistics live in shared memory: [version, n, mean, sum_sq].
+        Each collector pushes observations into its local delta, and merges the delta into shared memory
+        (under a lock) after sync_gap observations. The hot path reads the shared statistics without lock,
+        as a seqlock: the version is odd while a merge is writing, and a read retries if the version changed.
+        self.rs is the snapshot of the shared statistics loaded by this process.
+        Create it before starting the processes, and pass it to them as an argument.
+        """
+        super(SharedNormalization, self).__init__(shape, demean, destd, clip)
+        import multiprocessing as mp
+        self.sync_gap = sync_gap
+        self.size = int(np.prod(shape))
+
+        self.lock = mp.Lock()  # for the merge of collectors, not for reading
+        self.shared = mp.RawArray('d', 2 + self.size * 2)
+        self.delta = RunningStat(shape)  # the observations since last merge
+        self.version = 0.0  # the version of self.rs
+
+    def __call__(self, x, update=True):
+        if update:
+            if np.ndim(x) > len(self.rs.shape):
+                self.delta.push_batch(x)
+            else:
+                self.delta.push(x)
+            if self.delta.n >= min(self.sync_gap, self.rs.n):  # merge early while the statistics are few
+                self.sync()
+        if self.shared[0] != self.version:  # another collector merged its delta
+            self.load_snapshot()
+        return super(SharedNormalization, self).__call__(x, update=False)
+
+    def sync(self):  # merge the local delta into the shared statistics
+        if self.delta.n:
+            array = np.frombuffer(self.shared, dtype=np.float64)
+            with self.lock:
+                rs = self.get_shared_stat(array[1:])
+                rs.merge(self.delta)
+
+                array[0] += 1  # odd: writing
+                array[1] = rs.n
+                array[2:2 + self.size] = rs.mean.ravel()
+                array[2 + self.size:] = rs.sum_sq.ravel()
+                array[0] += 1  # even: finished
+            self.delta = RunningStat(self.rs.shape)
+        self.load_snapshot()
+
+    def load_snapshot(self):  # read the shared statistics without lock, retry if a merge is writing them
+        array = np.frombuffer(self.shared, dtype=np.float64)
+        while True:
+            version = array[0]
+            stat = array[1:].copy()
+            if version % 2 == 0 and array[0] == version:
+                break
+        self.rs = self.get_shared_stat(stat)
+        self.version = version
+
+    def get_shared_stat(self, stat):  # stat: [n, mean, sum_sq]
+        rs = RunningStat(self.rs.shape)
+        if stat[0]:
+            rs.push_stat(stat[0], stat[1:1 + self.size].reshape(rs.shape), stat[1 + self.size:].reshape(rs.shape))
+        return rs
+
+    def get_snapshot(self):  # the latest shared statistics, the same snapshot that the collectors read
+        self.load_snapshot()
+        return super(SharedNormalization, self).get_snapshot()
+
 
 class OrnsteinUhlenbeckProcess:
     def __init__(self, size, theta=0.15, sigma=0.3, x0=0.0, dt=1e-2):
@@ -1419,3 +2182,34 @@ def get_eva_reward(agent, env_list, max_step, max_action, running_state=None):
     act.train()
 
     return reward_sums
+
+
+def get_eva_reward_stack(act_stack, env_lists, max_step, max_action, random_seed=19430):  # tournament of M actors
+    """
+    act_stack: ActorDPGStack, M actors with stacked parameters, one batched forward per step over actors x envs
+    env_lists: M env lists of the same length E. env_lists[m][e] uses the same random seed for each actor m
+    return: rewards, np.array, shape == (M, E)
+    """
+    for env_list in env_lists:
+        for e, env in enumerate(env_list):
+            env.seed(random_seed + e)
+    states = np.array([[env.reset() for env in env_list] for env_list in env_lists], dtype=np.float32)
+
+    rewards = np.zeros(states.shape[:2])
+    is_alive = np.ones(states.shape[:2], dtype=np.bool_)
+    device = act_stack.net.weights[0].device
+    with torch.no_grad():
+        for _ in range(max_step):
+            actions = act_stack(torch.as_tensor(states, device=device)).cpu().numpy()  # shape == (M, E, action_dim)
+            if max_action:  # Continuous action space
+                actions *= max_action
+
+            for m, e in zip(*np.nonzero(is_alive)):
+                next_state, reward, done, _ = env_lists[m][e].step(actions[m, e])
+                states[m, e] = next_state
+                rewards[m, e] += reward
+                if done:
+                    is_alive[m, e] = False
+            if not is_alive.any():
+                break
+    return rewards
@@ -0,0 +1,293 @@
+import os
+from time import perf_counter as timer
+
+import gym
+import torch
+import numpy as np
+import numpy.random as rd
+
+'''
+Compare the latency (p50, p99) and throughput of policy inference.
+
+run__select_action(): select_actions((state,)) vs select_action(state), single state, AgentBasicAC, AgentPPO, AgentDQN
+run__numpy_actor(): torch actor vs NumpyActor (AgentInference.py), single state and batch, ActorDPG, ActorDL, ActorSAC, QNetwork
+run__int8_actor(): float32 actor vs int8 dynamically quantized actor, latency, throughput and the reward delta
+run__torch_script(): cold start (build agent and load actor.pth vs load *.pt) and latency, AgentPPO with AutoNormalization
+run__inference_server(): env processes with their own actor vs InferenceServer (dynamic batching), env steps per second
+run__distillation(): the actor of AgentSNAC (teacher) vs the distilled ActorDPG (student), latency and reward
+'''
+
+
+def get_latency(func, states, warm_up=2 ** 6):
+    for state in states[:warm_up]:
+        func(state)
+
+    latencies = np.empty(len(states))
+    for i, state in enumerate(states):
+        start_time = timer()
+        func(state)
+        latencies[i] = timer() - start_time
+    return latencies
+
+
+def print_latency(name, latencies):
+    p50, p99 = np.percentile(latencies, (50, 99)) * 1e6  # microsecond
+    print("{:32} |{:9.1f} {:9.1f} |{:10.0f}".format(name, p50, p99, 1 / np.average(latencies)))
+
+
+def run__select_action(test_num=2 ** 12):
+    from AgentZoo import AgentBasicAC, AgentPPO, AgentDQN
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''  # single state inference on CPU
+    torch.set_num_threads(1)
+    net_dim = 2 ** 7
+
+    env = gym.make("LunarLanderContinuous-v2")
+    state_dim = env.observation_space.shape[0]
+    action_dim = env.action_space.shape[0]
+    states = rd.randn(test_num, state_dim).astype(np.float32)
+
+    agent_list = [AgentBasicAC(state_dim, action_dim, net_dim),
+                  AgentPPO(state_dim, action_dim, net_dim), ]
+    env = gym.make("LunarLander-v2")  # Discrete action space for AgentDQN
+    agent_list.append(AgentDQN(env, state_dim, env.action_space.n, net_dim))
+
+    print("{:32} |{:>9} {:>9} |{:>10}".format('select action (single state)', 'p50 us', 'p99 us', 'call/s'))
+    for agent in agent_list:
+        agent.act.eval()
+        name = agent.__class__.__name__
+
+        with torch.no_grad():
+            latencies = get_latency(lambda state: agent.select_actions((state,))[0], states)
+        print_latency('{} select_actions'.format(name), latencies)
+
+        latencies = get_latency(lambda state: agent.select_action(state), states)
+        print_latency('{} select_action'.format(name), latencies)
+
+
+def run__numpy_actor(test_num=2 ** 12, batch_size=2 ** 8, cwd='InferenceSpeed'):
+    from AgentNetwork import ActorDPG, ActorDL, ActorSAC, QNetwork
+    from AgentInference import export_numpy_actor, get_torch_output, NumpyActor
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    torch.set_num_threads(1)
+    os.makedirs(cwd, exist_ok=True)
+    state_dim, action_dim, net_dim = 8, 2, 2 ** 7  # LunarLanderContinuous-v2
+    states = rd.randn(test_num, state_dim).astype(np.float32)
+    batches = [states[i:i + batch_size] for i in range(0, test_num, batch_size)]
+
+    act_list = [ActorDPG(state_dim, action_dim, net_dim),
+                ActorDL(state_dim, action_dim, net_dim, use_dense=True),
+                ActorSAC(state_dim, action_dim, net_dim),
+                QNetwork(state_dim, 4, net_dim), ]  # LunarLander-v2, Discrete action space
+
+    print("{:32} |{:>9} {:>9} |{:>10}".format('actor (single state, batch)', 'p50 us', 'p99 us', 'call/s'))
+    for act in act_list:
+        name = act.__class__.__name__
+        npz_path = export_numpy_actor(act, '{}/{}.npz'.format(cwd, name))  # it checks the float32 tolerance
+        np_act = NumpyActor(npz_path, max_batch_size=batch_size)
+
+        with torch.no_grad():
+            latencies = get_latency(lambda state: get_torch_output(act, torch.as_tensor((state,))).numpy(), states)
+            print_latency('{} torch'.format(name), latencies)
+            latencies = get_latency(lambda batch: get_torch_output(act, torch.as_tensor(batch)).numpy(), batches, 1)
+            print_latency('{} torch batch={}'.format(name, batch_size), latencies)
+
+        latencies = get_latency(lambda state: np_act.forward((state,)), states)
+        print_latency('{} NumPy'.format(name), latencies)
+        latencies = get_latency(lambda batch: np_act.forward(batch), batches, 1)
+        print_latency('{} NumPy batch={}'.format(name, batch_size), latencies)
+        print("{:32} | size of *.npz: {} bytes".format(name, os.path.getsize(npz_path)))
+
+        with torch.no_grad():
+            outputs = get_torch_output(act, torch.as_tensor(batches[0])).numpy()
+        print("{:32} | max output error: {:.2e}".format(name, np.abs(np_act.forward(batches[0]) - outputs).max()))
+
+
+def run__int8_actor(test_num=2 ** 12, batch_size=2 ** 8, eva_size=2 ** 4, max_step=2 ** 10, cwd_dict=None):
+    """
+    cwd_dict: {actor class name: cwd of actor.pth saved by Recorder}, such as {'ActorSAC': 'AC_SAC/LL_0'}.
+    The actor without actor.pth uses random initialization, so that the reward delta only checks the pipeline.
+    """
+    from AgentNetwork import ActorDPG, ActorDL, ActorSAC, ActorPPO, QNetwork
+    from AgentInference import quantize_actor_int8, get_eva_reward_delta, get_torch_output
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    torch.set_num_threads(1)
+    cwd_dict = dict() if cwd_dict is None else cwd_dict
+    env_name = "LunarLanderContinuous-v2"
+    state_dim, action_dim, net_dim = 8, 2, 2 ** 7
+    states = rd.randn(test_num, state_dim).astype(np.float32)
+    batches = [states[i:i + batch_size] for i in range(0, test_num, batch_size)]
+
+    act_list = [ActorDPG(state_dim, action_dim, net_dim),
+                ActorDL(state_dim, action_dim, net_dim, use_dense=False),
+                ActorSAC(state_dim, action_dim, net_dim),
+                ActorPPO(state_dim, action_dim, net_dim),
+                QNetwork(state_dim, 4, net_dim), ]  # LunarLander-v2, Discrete action space
+
+    print("{:32} |{:>9} {:>9} |{:>10}".format('actor (single state, batch)', 'p50 us', 'p99 us', 'call/s'))
+    for act in act_list:
+        name = act.__class__.__name__
+        if name in cwd_dict:
+            act.load_state_dict(torch.load('{}/actor.pth'.format(cwd_dict[name]), map_location='cpu'))
+        act.eval()
+        q_act = quantize_actor_int8(act)
+
+        with torch.no_grad():
+            for actor, dtype in ((act, 'float32'), (q_act, 'int8')):
+                latencies = get_latency(lambda state: get_torch_output(actor, torch.as_tensor((state,))), states)
+                print_latency('{} {}'.format(name, dtype), latencies)
+                latencies = get_latency(lambda batch: get_torch_output(actor, torch.as_tensor(batch)), batches, 1)
+                print_latency('{} {} batch={}'.format(name, dtype, batch_size), latencies)
+
+        is_discrete = name == 'QNetwork'
+        env_list = [gym.make("LunarLander-v2" if is_discrete else env_name) for _ in range(eva_size)]
+        rewards, q_rewards = get_eva_reward_delta(act, q_act, env_list, max_step, None if is_discrete else 1.0)
+        print("{:32} | reward float32 {:8.2f}  int8 {:8.2f}  delta {:8.2f}".format(
+            name, np.average(rewards), np.average(q_rewards), np.average(q_rewards) - np.average(rewards)))
+
+
+def run__torch_script(test_num=2 ** 12, cwd='InferenceSpeed'):
+    from AgentZoo import AgentPPO, AutoNormalization
+    from AgentInference import export_torch_script, TorchScriptActor
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    torch.set_num_threads(1)
+    os.makedirs(cwd, exist_ok=True)
+    state_dim, action_dim, net_dim = 8, 2, 2 ** 7  # LunarLanderContinuous-v2
+    states = rd.randn(test_num, state_dim).astype(np.float32)
+
+    agent = AgentPPO(state_dim, action_dim, net_dim)
+    state_norm = AutoNormalization((state_dim,), clip=6.0)
+    for state in states[:2 ** 8]:
+        state_norm(state * 4.0 + 1.0)
+    agent.save_or_load_model(cwd, is_save=True)
+    pt_path = export_torch_script(agent.act, '{}/actor_script.pt'.format(cwd), state_norm)
+
+    start_time = timer()
+    agent = AgentPPO(state_dim, action_dim, net_dim)
+    agent.save_or_load_model(cwd, is_save=False)
+    print("| cold start, AgentPPO and actor.pth: {:9.1f} ms".format((timer() - start_time) * 1e3))
+    start_time = timer()
+    act_script = TorchScriptActor(pt_path)
+    print("| cold start, TorchScriptActor:       {:9.1f} ms".format((timer() - start_time) * 1e3))
+
+    actions = agent.select_actions([state_norm(state, update=False) for state in states[:2 ** 8]])
+    print("| max action error: {:.2e}".format(np.abs(act_script.select_actions(states[:2 ** 8]) - actions).max()))
+
+    print("{:32} |{:>9} {:>9} |{:>10}".format('select action (single state)', 'p50 us', 'p99 us', 'call/s'))
+    with torch.no_grad():
+        latencies = get_latency(lambda state: agent.select_actions((state_norm(state, update=False),))[0], states)
+    print_latency('AgentPPO select_actions', latencies)
+    latencies = get_latency(lambda state: act_script.select_action(state), states)
+    print_latency('TorchScriptActor select_action', latencies)
+
+
+def process__env_steps(env_name, load_policy, step_num, q_steps):  # load_policy: a local actor or InferenceClient
+    torch.set_num_threads(1)
+    policy = load_policy()
+    env = gym.make(env_name)
+    state = env.reset()
+
+    start_time = timer()
+    for _ in range(step_num):
+        action = policy.select_actions((state,))[0]
+        state, reward, done, _ = env.step(action)
+        if done:
+            state = env.reset()
+    steps_per_second = step_num / (timer() - start_time)
+
+    if hasattr(policy, 'get_stats'):  # InferenceClient
+        q_steps.put((steps_per_second, policy.get_stats()))
+        policy.close()
+    else:
+        q_steps.put((steps_per_second, None))
+
+
+def run__inference_server(process_num=16, step_num=2 ** 12, cwd='InferenceSpeed'):
+    import time
+    import functools
+    import multiprocessing as mp
+    from AgentNetwork import ActorDPG
+    from AgentInference import export_torch_script, TorchScriptActor, InferenceClient, process__inference_server
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    os.makedirs(cwd, exist_ok=True)
+    env_name = "LunarLanderContinuous-v2"
+    state_dim, action_dim, net_dim = 8, 2, 2 ** 7
+    pt_path = export_torch_script(ActorDPG(state_dim, action_dim, net_dim), '{}/actor_script.pt'.format(cwd))
+    address = os.path.abspath('{}/inference.sock'.format(cwd))
+
+    print("{:32} |{:>12}".format('{} env processes'.format(process_num), 'step/s'))
+    for use_server in (False, True):
+        server = None
+        if use_server:
+            server = mp.Process(target=process__inference_server,
+                                args=(address, functools.partial(TorchScriptActor, pt_path, 1)))
+            server.start()
+            while not os.path.exists(address):
+                time.sleep(0.01)
+            load_policy = functools.partial(InferenceClient, address)
+        else:
+            load_policy = functools.partial(TorchScriptActor, pt_path, 1)
+
+        q_steps = mp.Queue()
+        processes = [mp.Process(target=process__env_steps, args=(env_name, load_policy, step_num, q_steps))
+                     for _ in range(process_num)]
+        [process.start() for process in processes]
+        results = [q_steps.get() for _ in range(process_num)]
+        steps_per_second = sum(result[0] for result in results)
+        print("{:32} |{:12.0f}".format('InferenceServer' if use_server else 'actor in each process', steps_per_second))
+
+        if use_server:
+            print("| InferenceServer stats: {}".format(results[-1][1]))
+            client = InferenceClient(address)
+            client.shutdown_server()
+            client.close()
+        [process.join() for process in processes]
+        if server is not None:
+            server.join()
+
+
+def run__distillation(cwd='AC_SNAC/LL_0', net_dim=2 ** 7, student_dim=2 ** 6, eva_size=2 ** 4, max_step=2 ** 10,
+                      test_num=2 ** 12):
+    from AgentNetwork import ActorDL
+    from AgentInference import distill_actor, get_eva_reward_delta, get_torch_output
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    torch.set_num_threads(1)
+    env_name = "LunarLanderContinuous-v2"
+    env = gym.make(env_name)
+    state_dim = env.observation_space.shape[0]
+    action_dim = env.action_space.shape[0]
+    max_action = float(env.action_space.high[0])
+
+    teacher = ActorDL(state_dim, action_dim, net_dim, use_dense=True)  # the actor of AgentSNAC
+    act_path = '{}/actor.pth'.format(cwd)  # saved by Recorder, such as AgentRun.run__zoo(gpu_id=0, cwd='AC_SNAC')
+    teacher.load_state_dict(torch.load(act_path, map_location='cpu'))
+    student = distill_actor(teacher, env, max_action, student_dim)
+    torch.save(student.state_dict(), '{}/actor_student.pth'.format(cwd))
+
+    states = rd.randn(test_num, state_dim).astype(np.float32)
+    env_list = [gym.make(env_name) for _ in range(eva_size)]
+    rewards_list = get_eva_reward_delta(teacher, student, env_list, max_step, max_action)
+
+    print("{:32} |{:>9} {:>9} |{:>10} |{:>8} {:>8}".format(
+        'actor (single state)', 'p50 us', 'p99 us', 'call/s', 'r_avg', 'r_std'))
+    for name, act, rewards in (('teacher ActorDL', teacher, rewards_list[0]),
+                               ('student ActorDPG', student, rewards_list[1])):
+        with torch.no_grad():
+            latencies = get_latency(lambda state: get_torch_output(act, torch.as_tensor((state,))), states)
+        p50, p99 = np.percentile(latencies, (50, 99)) * 1e6
+        print("{:32} |{:9.1f} {:9.1f} |{:10.0f} |{:8.2f} {:8.2f}".format(
+            name, p50, p99, 1 / np.average(latencies), np.average(rewards), np.std(rewards)))
+
+
+if __name__ == '__main__':
+    run__select_action()
+    run__numpy_actor()
+    run__int8_actor()
+    run__torch_script()
+    run__inference_server()
+    run__distillation()
@@ -56,16 +56,29 @@ class RunningStat(object):
         self._M = np.zeros(shape)
         self._S = np.zeros(shape)
 
-    def push(self, x):
+    def push(self, x):  # one observation, x.shape == self.shape
         x = np.asarray(x)
-        assert x.shape == self._M.shape
         self._n += 1
-        if self._n == 1:
-            self._M[...] = x
-        else:
-            oldM = self._M.copy()
-            self._M[...] = oldM + (x - oldM) / self._n
-            self._S[...] = self._S + (x - oldM) * (x - self._M)
+        delta = x - self._M
+        self._M += delta / self._n
+        self._S += delta * (x - self._M)
+
+    def push_batch(self, xs):  # a batch of observations, xs.shape == (batch_size, *self.shape)
+        xs = np.asarray(xs)
+        if len(xs):
+            mean = xs.mean(axis=0)
+            self.push_stat(len(xs), mean, np.square(xs - mean).sum(axis=0))
+
+    def merge(self, other):  # merge the statistics of another RunningStat, such as the one of another worker
+        if other.n:
+            self.push_stat(other.n, other.mean, other._S)
+
+    def push_stat(self, n, mean, sum_sq):  # parallel Welford (Chan et al.), sum_sq: sum of squared deviations
+        pre_n = self._n
+        self._n = pre_n + n
+        delta = mean - self._M
+        self._M += delta * (n / self._n)
+        self._S += sum_sq + np.square(delta) * (pre_n * n / self._n)
 
     @property
     def n(self):
@@ -101,9 +114,12 @@ class ZFilter:
 
         self.rs = RunningStat(shape)
 
-    def __call__(self, x, update=True):
+    def __call__(self, x, update=True):  # x can be a batch of observations, x.shape == (batch_size, *shape)
         if update:
-            self.rs.push(x)
+            if np.ndim(x) > len(self.rs.shape):
+                self.rs.push_batch(x)
+            else:
+                self.rs.push(x)
         if self.demean:
             x = x - self.rs.mean
         if self.destd:
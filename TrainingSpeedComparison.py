@@ -0,0 +1,237 @@
+import os
+from time import time as timer
+
+import gym
+import torch
+import numpy as np
+
+from AgentRun import get_env_info
+from AgentZoo import BufferArray, initial_exploration, get_eva_reward
+
+'''
+Compare the training speed (parameters updates per second) and the final reward of different training settings.
+
+run__bf16_autocast(): float32 vs bfloat16 CPU autocast, AgentSNAC and AgentTD3, LunarLanderContinuous-v2
+run__compiled_step(): eager mode vs torch.compile loss functions, AgentTD3, AgentSAC and AgentInterAC,
+    LunarLanderContinuous-v2, and check_compiled_loss() of these agents and AgentDQN
+run__cpu_plan(): set_num_threads(8) in each process vs plan_cpu_threads(), aggregate steps per second of 4 processes
+run__ppo_shared_trunk(): AgentPPO with separate actor and critic vs shared trunk, LunarLanderContinuous-v2
+'''
+
+
+def train_and_evaluate(class_agent, env_name, net_dim=2 ** 7, max_step=2 ** 10, max_memo=2 ** 17, max_epoch=2 ** 6,
+                       batch_size=2 ** 7, repeat_times=1, reward_scale=1, gamma=0.99, eva_size=2 ** 4,
+                       random_seed=19430, init_agent=None):
+    np.random.seed(random_seed)
+    torch.manual_seed(random_seed)
+
+    env = gym.make(env_name)
+    state_dim, action_dim, max_action, target_reward, is_discrete = get_env_info(env, is_print=False)
+
+    agent = class_agent(state_dim, action_dim, net_dim)
+    agent.state = env.reset()
+    if init_agent is not None:  # set the training mode of agent, such as `agent.use_bf16 = True`
+        init_agent(agent)
+    buffer = BufferArray(max_memo, state_dim, action_dim=1 if is_discrete else action_dim)
+
+    with torch.no_grad():
+        initial_exploration(env, buffer, max_step, max_action, reward_scale, gamma, action_dim)
+
+    update_time = 0.0
+    update_num = 0
+    for epoch in range(max_epoch):
+        with torch.no_grad():
+            agent.update_buffer(env, buffer, max_step, max_action, reward_scale, gamma)
+        buffer.init_before_sample()
+
+        update_num += int(max_step * (1.0 + buffer.now_len / buffer.max_len)) * repeat_times  # see update_parameters
+        start_time = timer()
+        loss_a, loss_c = agent.update_parameters(buffer, max_step, batch_size, repeat_times)
+        float(loss_a), float(loss_c)  # wait for the lazy loss on device
+        update_time += timer() - start_time
+
+    env_list = [gym.make(env_name) for _ in range(eva_size)]
+    with torch.no_grad():
+        rewards = get_eva_reward(agent, env_list, max_step, max_action)
+    return update_num / update_time, float(np.average(rewards)), float(np.std(rewards))
+
+
+def run__bf16_autocast():
+    from AgentZoo import AgentSNAC, AgentTD3
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''  # autocast in bfloat16 on CPU
+    torch.set_num_threads(8)
+    env_name = "LunarLanderContinuous-v2"
+
+    print("{:12} {:8} |{:>10} {:>8} {:>8}".format('Agent', 'dtype', 'Update/s', 'r_avg', 'r_std'))
+    for class_agent in (AgentSNAC, AgentTD3):
+        for use_bf16 in (False, True):
+            def init_agent(agent):
+                agent.use_bf16 = use_bf16
+
+            updates_per_second, r_avg, r_std = train_and_evaluate(class_agent, env_name, init_agent=init_agent)
+            print("{:12} {:8} |{:10.1f} {:8.2f} {:8.2f}".format(
+                class_agent.__name__, 'bfloat16' if use_bf16 else 'float32', updates_per_second, r_avg, r_std))
+
+
+def check_compiled_loss(get_agent, state_dim, action_dim, max_step=2 ** 4, batch_size=2 ** 7, random_seed=19430):
+    """
+    Run update_parameters() of two agents from get_agent() with the same initial parameters, eager mode and
+    init_compiled_step(), on the same random buffer,
+    with the same random numbers (the random ops of compiled function fall back to the eager generator).
+    action_dim: the action of AgentDQN is the index of discrete action, its buffer has action_dim=1
+    return: (loss_a, loss_c) of eager mode, (loss_a, loss_c) of compiled mode, is_compiled (without eager fall back)
+    """
+    import torch._inductor.config
+    from AgentZoo import CompiledFunction
+    torch._inductor.config.fallback_random = True
+
+    np.random.seed(random_seed)
+    buffer = BufferArray(2 ** 12, state_dim, action_dim)
+    for _ in range(2 ** 12):
+        action = np.random.randint(4, size=action_dim) if action_dim == 1 else np.random.uniform(-1, 1, action_dim)
+        buffer.add_memo((np.random.randn(1), 0.99, np.random.randn(state_dim), action, np.random.randn(state_dim)))
+    buffer.init_before_sample()
+
+    losses = list()
+    for use_compile in (False, True):
+        torch.manual_seed(random_seed)
+        agent = get_agent()
+        if use_compile:
+            agent.init_compiled_step()
+
+        np.random.seed(random_seed)
+        torch.manual_seed(random_seed)
+        loss_a, loss_c = agent.update_parameters(buffer, max_step, batch_size, 1)
+        losses.append((float(loss_a), float(loss_c)))
+
+    is_compiled = all(func.compiled_func is not None
+                      for func in vars(agent).values() if isinstance(func, CompiledFunction))
+    return losses[0], losses[1], is_compiled
+
+
+def run__compiled_step(max_epoch=2 ** 6):
+    from AgentZoo import AgentTD3, AgentSAC, AgentInterAC, AgentDQN
+
+    torch.set_num_threads(8)
+    env_name = "LunarLanderContinuous-v2"
+    state_dim, action_dim, net_dim = 8, 2, 2 ** 7
+
+    print("{:12} |{:>10} {:>10} |{:>10} {:>10} |{:>9}".format(
+        'Agent', 'eager L_a', 'compile', 'eager L_c', 'compile', 'compiled'))
+    for class_agent in (AgentTD3, AgentSAC, AgentInterAC, AgentDQN):
+        if class_agent is AgentDQN:  # Discrete action space, the buffer saves the index of action
+            def get_agent():
+                return AgentDQN(gym.make("LunarLander-v2"), state_dim, 4, net_dim)
+
+            buffer_action_dim = 1
+        else:
+            def get_agent():
+                return class_agent(state_dim, action_dim, net_dim)
+
+            buffer_action_dim = action_dim
+        (loss_a, loss_c), (compiled_loss_a, compiled_loss_c), is_compiled = check_compiled_loss(
+            get_agent, state_dim, buffer_action_dim)
+        print("{:12} |{:10.6f} {:10.6f} |{:10.6f} {:10.6f} |{:>9}".format(
+            class_agent.__name__, loss_a, compiled_loss_a, loss_c, compiled_loss_c, str(is_compiled)))
+
+    print("{:12} {:8} |{:>10} {:>8} {:>8}".format('Agent', 'mode', 'Update/s', 'r_avg', 'r_std'))
+    for class_agent in (AgentTD3, AgentSAC, AgentInterAC):
+        for use_compile in (False, True):
+            def init_agent(agent):
+                if use_compile:
+                    agent.init_compiled_step()
+
+            updates_per_second, r_avg, r_std = train_and_evaluate(class_agent, env_name, max_epoch=max_epoch,
+                                                                  init_agent=init_agent)
+            print("{:12} {:8} |{:10.1f} {:8.2f} {:8.2f}".format(
+                class_agent.__name__, 'compile' if use_compile else 'eager', updates_per_second, r_avg, r_std))
+
+
+def process__train_speed(cpu_plan, env_name, max_step, max_epoch, q_speed):
+    from AgentRun import apply_cpu_plan
+    from AgentZoo import AgentTD3
+    if cpu_plan is None:
+        torch.set_num_threads(8)  # the default of Arguments.init_for_training()
+    else:
+        apply_cpu_plan(cpu_plan)
+
+    start_time = timer()
+    train_and_evaluate(AgentTD3, env_name, max_step=max_step, max_epoch=max_epoch, eva_size=1)
+    q_speed.put(max_step * max_epoch / (timer() - start_time))  # env steps (with updates) per second
+
+
+def run__cpu_plan(process_num=4, max_step=2 ** 10, max_epoch=2 ** 4):
+    import multiprocessing as mp
+    from AgentRun import plan_cpu_threads
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    env_name = "LunarLanderContinuous-v2"
+
+    print("{:24} |{:>10}".format('{} processes'.format(process_num), 'step/s'))
+    for cpu_plans in ([None, ] * process_num, plan_cpu_threads(process_num)):
+        q_speed = mp.Queue()
+        processes = [mp.Process(target=process__train_speed, args=(cpu_plan, env_name, max_step, max_epoch, q_speed))
+                     for cpu_plan in cpu_plans]
+        [process.start() for process in processes]
+        steps_per_second = sum(q_speed.get() for _ in processes)
+        [process.join() for process in processes]
+        print("{:24} |{:10.1f}".format('set_num_threads(8)' if cpu_plans[0] is None else 'plan_cpu_threads()',
+                                       steps_per_second))
+    print("| plan_cpu_threads({}): {}".format(process_num, plan_cpu_threads(process_num)))
+
+
+def train_and_evaluate_ppo(class_agent, env_name, net_dim=2 ** 7, max_step=2 ** 10, max_memo=2 ** 11, max_epoch=2 ** 8,
+                           batch_size=2 ** 8, repeat_times=2 ** 3, reward_scale=1, gamma=0.99, eva_size=2 ** 4,
+                           random_seed=19430):  # the on-policy loop of AgentRun.train_agent_ppo()
+    from AgentZoo import BufferArrayPPO, AutoNormalization
+    np.random.seed(random_seed)
+    torch.manual_seed(random_seed)
+
+    env = gym.make(env_name)
+    state_dim, action_dim, max_action, target_reward, is_discrete = get_env_info(env, is_print=False)
+
+    agent = class_agent(state_dim, action_dim, net_dim)
+    buffer = BufferArrayPPO(max_memo + max_step, state_dim, action_dim)
+    state_norm = AutoNormalization((state_dim,), clip=6.0)
+
+    update_time = 0.0
+    update_num = 0
+    for epoch in range(max_epoch):
+        buffer.empty_memories()
+        with torch.no_grad():
+            agent.update_buffer_ppo(env, buffer, max_step, max_memo, max_action, reward_scale, gamma, state_norm)
+
+        start_time = timer()
+        loss_a, loss_c = agent.update_parameters_ppo(buffer, batch_size, repeat_times)
+        float(loss_a), float(loss_c)  # wait for the lazy loss on device
+        update_time += timer() - start_time
+        update_num += agent.metrics.count('loss_c')  # each minibatch updates the critic, early stop skips actor steps
+
+    env_list = [gym.make(env_name) for _ in range(eva_size)]
+    with torch.no_grad():
+        rewards = get_eva_reward(agent, env_list, max_step, max_action, running_state=state_norm)
+    return update_num / update_time, float(np.average(rewards)), float(np.std(rewards))
+
+
+def run__ppo_shared_trunk():
+    from AgentZoo import AgentPPO
+
+    torch.set_num_threads(8)
+    env_name = "LunarLanderContinuous-v2"
+
+    print("{:12} {:8} |{:>10} {:>8} {:>8}".format('Agent', 'network', 'Update/s', 'r_avg', 'r_std'))
+    for use_shared_trunk in (False, True):
+        def class_agent(state_dim, action_dim, net_dim):
+            return AgentPPO(state_dim, action_dim, net_dim, use_shared_trunk=use_shared_trunk)
+
+        updates_per_second, r_avg, r_std = train_and_evaluate_ppo(class_agent, env_name)
+        print("{:12} {:8} |{:10.1f} {:8.2f} {:8.2f}".format(
+            'AgentPPO', 'shared' if use_shared_trunk else 'separate', updates_per_second, r_avg, r_std))
+
+
+if __name__ == '__main__':
+    run__bf16_autocast()
+    run__compiled_step()
+    run__cpu_plan()
+    run__ppo_shared_trunk()